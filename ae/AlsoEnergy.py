@@ -1,13 +1,25 @@
+# conda install pyarrow (only for the parquet output format)
 import os
 import time
 from selenium import webdriver
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
+from selenium.common.exceptions import TimeoutException
 from datetime import date
 from datetime import timedelta
+import numpy as np
 import pandas as pd
 import logging
+import requests
+import json
+import queue
+import threading
+import sys
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from data_lib import QualityControl as qc
 
 
 class AlsoEnergy:
@@ -20,7 +32,26 @@ class AlsoEnergy:
     startDate = date(date.today().year, date.today().month, date.today().day) - timedelta(days=1)
     endDate = date(date.today().year, date.today().month, date.today().day) - timedelta(days=1)
     timeout = 20
+    downloadTimeout = 30
+    daysPerExport = 1
+    pollInterval = 0.1
+    # direct HTTP export, exportUrl is the request behind "download CSV" with {start} and {end} placeholders
+    exportUrl = None
+    maxWorkers = 4
+    session = None
+    # browsers working through the missing days in parallel, each with its own download directory
+    browserWorkers = 1
+    lock = threading.Lock()
+    # cookies of the last login, reused while the session is still valid
+    sessionFile = None
+    sessionCheckTimeout = 20
     alsoNameList = ["Time","GHI","POA","ambient_temp","module_temp"]
+    # explicit time formats of the export and of cleaned files, tried in order
+    timeFormats = ["%Y-%m-%d %H:%M:%S", "%m/%d/%Y %I:%M:%S %p", "%m/%d/%Y %I:%M %p", "%m/%d/%Y %H:%M"]
+    # cleaned days are written as 'csv', 'parquet' or 'both', with 'parquet' the downloaded csv is kept for re-cleaning
+    outputFormat = 'csv'
+    # quality control rules applied to every download
+    qcRules = qc.ae_clean_rules
     # private properties
     __username = ''
     __password = ''
@@ -29,6 +60,8 @@ class AlsoEnergy:
         self.path = path
         self.driverPath = driverPath
         self.chromePath = chromePath
+        # browsers running on restored cookies until their first export succeeds
+        self.restoredDrivers = set()
     
     # credential information get method
     def setUserName(self, username):
@@ -42,13 +75,30 @@ class AlsoEnergy:
         
     def setEndDate(self, end_date):
         self.endDate = end_date
+
+    def setDownloadTimeout(self, downloadTimeout):
+        self.downloadTimeout = downloadTimeout
+
+    def waitForDownload(self, filename):
+        # returns as soon as Chrome has finished the .crdownload partial file and renamed it to filename
+        deadline = time.monotonic() + self.downloadTimeout
+        size = -1
+        while time.monotonic() < deadline:
+            downloading = any(file.endswith('.crdownload') for file in os.listdir(os.path.dirname(filename)))
+            if(not downloading and os.path.isfile(filename)):
+                current = os.path.getsize(filename)
+                if(current > 0 and current == size):
+                    return True
+                size = current
+            time.sleep(self.pollInterval)
+        return False
         
-    def enable_download_headless(self,driver):
+    def enable_download_headless(self,driver,downloadPath=None):
         driver.command_executor._commands["send_command"] = ("POST", '/session/$sessionId/chromium/send_command')
-        params = {'cmd':'Page.setDownloadBehavior', 'params': {'behavior': 'allow', 'downloadPath': self.path}}
+        params = {'cmd':'Page.setDownloadBehavior', 'params': {'behavior': 'allow', 'downloadPath': downloadPath or self.path}}
         driver.execute("send_command", params)
 
-    def initChromeDriver(self):
+    def initChromeDriver(self, downloadPath=None):
         option = webdriver.ChromeOptions()
         option.binary_location = self.chromePath
         option.add_argument("--headless")
@@ -60,11 +110,66 @@ class AlsoEnergy:
         print(self.driverPath)
         driver = webdriver.Chrome(executable_path=self.driverPath, options=option)
         #driver = webdriver.Chrome(options=option)
-        self.enable_download_headless(driver)
+        self.enable_download_headless(driver, downloadPath)
 
         return driver
 
-    def loginWebsite(self, driver):
+    def setSessionFile(self, sessionFile):
+        self.sessionFile = sessionFile
+
+    def isLoggedIn(self, driver):
+        # the session is only valid once the chartbuilder shows its export button, an expired one ends on the login form
+        yesterday = (date.today() - timedelta(days=1)).strftime("%Y-%m-%d")
+        driver.get(self.composeChartUrl(yesterday, yesterday))
+        try:
+            WebDriverWait(driver, self.sessionCheckTimeout).until(
+                lambda d: len(d.find_elements(By.ID, "username"))>0 or len(d.find_elements(By.ID, "data-export-button"))>0)
+            return len(driver.find_elements(By.ID, "data-export-button"))>0
+        except TimeoutException:
+            return False
+
+    def restoreSession(self, driver):
+        if(self.sessionFile is None or not os.path.isfile(self.sessionFile)):
+            return False
+        try:
+            with open(self.sessionFile, 'r') as f:
+                cookies = json.load(f)
+            # cookies can only be added on their own domain, and the home page redirects when logged out
+            driver.get(self.url + "favicon.ico")
+            now = time.time()
+            for cookie in cookies:
+                if(cookie.get('expiry', now + 1) > now):
+                    driver.add_cookie(cookie)
+            return self.isLoggedIn(driver)
+        except Exception as e:
+            print("Also Energy session restore failed: ", e)
+            return False
+
+    def saveSession(self, driver):
+        if(self.sessionFile is None):
+            return
+        try:
+            # wait for the login to leave the password form so the session cookies are set
+            WebDriverWait(driver, self.timeout).until(
+                lambda d: len(d.find_elements(By.ID, "password"))==0)
+            cookies = driver.get_cookies()
+            with self.lock:
+                tmp_file = self.sessionFile + ".tmp"
+                fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+                with os.fdopen(fd, 'w') as f:
+                    json.dump(cookies, f)
+                os.replace(tmp_file, self.sessionFile)
+        except Exception as e:
+            print("Also Energy session save failed: ", e)
+
+    def loginWebsite(self, driver, restore=True):
+
+        # a saved session skips the username and password steps
+        if(restore and self.restoreSession(driver)):
+            print("Also Energy session restored!")
+            with self.lock:
+                self.restoredDrivers.add(driver)
+            return
     
         driver.get(self.url)
 
@@ -89,6 +194,200 @@ class AlsoEnergy:
                 
         element.click()
         print("Also Energy login succeed!")
+        self.saveSession(driver)
+
+    def setDaysPerExport(self, daysPerExport):
+        self.daysPerExport = daysPerExport
+
+    def composeChartUrl(self, start, end):
+        # a single day keeps the day view, longer ranges use a custom period
+        period = 'day' if start == end else 'custom'
+        #url = 'https://apps.alsoenergy.com/powertrack/S40225/analysis/chartbuilder?start='+yesterday+'&end='+yesterday+'&d=day&bin=1&k=%7B~measurements~%3A%5B4%2C8%5D%7D&m=k&a=0&h=5&c=259&s=1'
+        return 'https://apps.alsoenergy.com/powertrack/S40225/analysis/chartbuilder?start='+start+'&end='+end+'&d='+period+'&bin=1&k=%7B~measurements~%3A%5B4%2C8%5D%7D&m=k&a=0&h=5&c=259&s=1&i=%7B~includeGHI~%3Atrue%7D'
+
+    def listMissingDays(self):
+        days = []
+        currentDate = self.startDate
+        while currentDate <= self.endDate:
+            yesterday = currentDate.strftime("%Y-%m-%d")
+            if(os.path.isfile(self.path+'ae_'+yesterday+'.csv') or os.path.isfile(self.path+'ae_'+yesterday+'.parquet')):
+                print("ae_"+ yesterday + " file already existed!")
+            else:
+                days.append(currentDate)
+            currentDate = currentDate + timedelta(days=1)
+        return days
+
+    def groupWindows(self, days):
+        # consecutive missing days are grouped into windows of up to daysPerExport days
+        windows = []
+        for currentDate in days:
+            if(len(windows)>0 and len(windows[-1])<self.daysPerExport and windows[-1][-1]+timedelta(days=1)==currentDate):
+                windows[-1].append(currentDate)
+            else:
+                windows.append([currentDate])
+        return windows
+
+    def downloadChart(self, driver, start, end, downloadPath):
+        driver.get(self.composeChartUrl(start, end))
+        
+        element = WebDriverWait(driver, 60).until(
+            #EC.presence_of_element_located((By.ID, "chart-more-options-button")))
+            EC.presence_of_element_located((By.ID, "data-export-button")))
+        element.click()
+        
+        # a file left over from an earlier failed day must not be taken for this one
+        if(os.path.isfile(downloadPath+self.filename)):
+            os.remove(downloadPath+self.filename)
+
+        element = WebDriverWait(driver, 20).until(
+            EC.presence_of_element_located((By.ID, "chart-more-options-download-csv")))
+        element.click()
+
+        if(not self.waitForDownload(downloadPath+self.filename)):
+            raise Exception("download timed out")
+
+    def splitExport(self, filename, days):
+        # write each day of a range export as its own raw file, then clean it as a single-day download would be
+        df = pd.read_csv(filename, dtype=str)
+        time_list = self.parseTime(df.iloc[:, 0])
+        day_list = time_list.dt.strftime("%Y-%m-%d").values
+        missing = []
+        for currentDate in days:
+            yesterday = currentDate.strftime("%Y-%m-%d")
+            mask = day_list == yesterday
+            # a day that is absent or stops before 23:59 was cut off by the export
+            if(not mask.any() or time_list[mask].max().strftime("%H:%M") != "23:59"):
+                missing.append(currentDate)
+                continue
+            dst_filename = self.path+'ae_'+yesterday+'.csv'
+            df[mask].to_csv(dst_filename, index=False)
+            self.cleanData(dst_filename)
+            print("ae_" + yesterday +" download succeed")
+        return missing
+
+    def exportRange(self, driver, days, downloadPath=None):
+        downloadPath = downloadPath or self.path
+        start = days[0].strftime("%Y-%m-%d")
+        end = days[-1].strftime("%Y-%m-%d")
+        with self.lock:
+            restored = driver in self.restoredDrivers
+            self.restoredDrivers.discard(driver)
+        try:
+            self.downloadChart(driver, start, end, downloadPath)
+            if(len(days)==1):
+                dst_filename = self.path+'ae_'+start+'.csv'
+                os.rename(downloadPath+self.filename, dst_filename)      
+                if(os.path.isfile(dst_filename)):
+                    self.cleanData(dst_filename)
+                    print("ae_" + start +" download succeed")
+                return []
+            missing = self.splitExport(downloadPath+self.filename, days)
+            os.remove(downloadPath+self.filename)
+            return missing
+        except  Exception as e:
+            if(restored):
+                # the restored cookies did not hold, log in with the password and try again
+                print("Also Energy restored session rejected, logging in again")
+                self.loginWebsite(driver, restore=False)
+                return self.exportRange(driver, days, downloadPath)
+            if(len(days)>1):
+                print("ae_"+ start + " to " + end + " range export failed, retry day by day")
+                return days
+            print("ae_"+ start + " download failed")
+            #logging.error('Failed to do something: ' + str(e))
+            self.recordException("ae_"+ start)
+            return []
+
+    def setExportUrl(self, exportUrl):
+        self.exportUrl = exportUrl
+
+    def setMaxWorkers(self, maxWorkers):
+        self.maxWorkers = maxWorkers
+
+    def openSession(self, driver):
+        # reuse the cookies of the browser login in a pooled HTTP session
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=max(self.maxWorkers, 1))
+        self.session.mount('https://', adapter)
+        self.session.headers.update({'User-Agent': driver.execute_script("return navigator.userAgent")})
+        for cookie in driver.get_cookies():
+            self.session.cookies.set(cookie['name'], cookie['value'], domain=cookie.get('domain'), path=cookie.get('path', '/'))
+        return self.session
+
+    def closeSession(self):
+        if(self.session is not None):
+            self.session.close()
+            self.session = None
+
+    def exportDirect(self, days):
+        # returns the days that still need the browser
+        start = days[0].strftime("%Y-%m-%d")
+        end = days[-1].strftime("%Y-%m-%d")
+        tmp_filename = self.path+'chart-data_'+start+'_'+end+'.csv'
+        try:
+            response = self.session.get(self.exportUrl.format(start=start, end=end), timeout=self.downloadTimeout)
+            if(response.status_code != 200):
+                raise Exception("status " + str(response.status_code))
+            with open(tmp_filename, 'w') as f:
+                f.write(response.text)
+            # an expired session returns a login page instead of csv, splitExport rejects it
+            return self.splitExport(tmp_filename, days)
+        except Exception as e:
+            print("ae_"+ start + " to " + end + " direct export failed: ", e)
+            return days
+        finally:
+            if(os.path.isfile(tmp_filename)):
+                os.remove(tmp_filename)
+
+    def recordException(self, filename):
+        with self.lock:
+            flag = 0
+            # Open the file in append mode
+            with open('exception/sp.txt', 'r') as f:
+                for line in f:
+                # Check if the string exists in the line
+                    if filename in line.strip():
+                        # Write the new line
+                        flag = 1
+
+
+            if(flag == 0):
+                with open('exception/sp.txt', 'a') as f:
+                    f.write(filename + "\n")
+
+    def setBrowserWorkers(self, browserWorkers):
+        self.browserWorkers = browserWorkers
+
+    def exportWindows(self, driver, windows, downloadPath=None):
+        for window in windows:
+            missing = self.exportRange(driver, window, downloadPath)
+            # days a range export did not cover are downloaded one by one
+            if(len(window)>1):
+                for currentDate in missing:
+                    self.exportRange(driver, [currentDate], downloadPath)
+
+    def runWorker(self, index, driver, windowQueue):
+        # a worker logs in once and keeps its browser and download directory until the queue is empty
+        downloadPath = self.path if index == 0 else self.path+'worker_'+str(index)+'/'
+        try:
+            if(driver is None):
+                os.makedirs(downloadPath, exist_ok=True)
+                driver = self.initChromeDriver(downloadPath)
+                self.loginWebsite(driver)
+            while True:
+                try:
+                    window = windowQueue.get_nowait()
+                except queue.Empty:
+                    break
+                self.exportWindows(driver, [window], downloadPath)
+        except Exception as e:
+            print("ae worker", index, "failed: ", e)
+        finally:
+            if(index > 0):
+                if(driver is not None):
+                    driver.quit()
+                if(os.path.isdir(downloadPath) and len(os.listdir(downloadPath))==0):
+                    os.rmdir(downloadPath)
 
     def AlsoEnergy(self):
         # initialize web driver
@@ -96,64 +395,92 @@ class AlsoEnergy:
         # login to the website
         self.loginWebsite(driver)
 
-        while self.startDate <= self.endDate:
-            yesterday = self.startDate.strftime("%Y-%m-%d")
-            dst_filename = self.path+'ae_'+yesterday+'.csv'
-            self.startDate = self.startDate + timedelta(days=1)
-            if(os.path.isfile(dst_filename)):
-                print("ae_"+ yesterday + " file already existed!")
-                continue
-            try:
-                #url = 'https://apps.alsoenergy.com/powertrack/S40225/analysis/chartbuilder?start='+yesterday+'&end='+yesterday+'&d=day&bin=1&k=%7B~measurements~%3A%5B4%2C8%5D%7D&m=k&a=0&h=5&c=259&s=1'
-                url = 'https://apps.alsoenergy.com/powertrack/S40225/analysis/chartbuilder?start='+yesterday+'&end='+yesterday+'&d=day&bin=1&k=%7B~measurements~%3A%5B4%2C8%5D%7D&m=k&a=0&h=5&c=259&s=1&i=%7B~includeGHI~%3Atrue%7D'
-                driver.get(url)
-                
-                element = WebDriverWait(driver, 60).until(
-                    #EC.presence_of_element_located((By.ID, "chart-more-options-button")))
-                    EC.presence_of_element_located((By.ID, "data-export-button")))
-                element.click()
-                
-                element = WebDriverWait(driver, 20).until(
-                    EC.presence_of_element_located((By.ID, "chart-more-options-download-csv")))
-                element.click()
-                time.sleep(3)
-
-                if(os.path.isfile(self.path+self.filename)):
-                    os.rename(self.path+self.filename, dst_filename)      
-                    if(os.path.isfile(dst_filename)):
-                        self.cleanData(dst_filename)
-                        print("ae_" + yesterday +" download succeed")
-            except  Exception as e:
-                print("ae_"+ yesterday + " download failed")
-                #logging.error('Failed to do something: ' + str(e))
-
-                flag = 0
-                # Open the file in append mode
-                with open('exception/sp.txt', 'r') as f:
-                    for line in f:
-                    # Check if the string exists in the line
-                        if "ae_"+ yesterday in line.strip():
-                            # Write the new line
-                            flag = 1
-
-
-                if(flag == 0):
-                    with open('exception/sp.txt', 'a') as f:
-                        f.write("ae_"+ yesterday + "\n")
+        windows = self.groupWindows(self.listMissingDays())
+        if(self.exportUrl is not None):
+            # the browser is only needed for the login, exports run concurrently over HTTP
+            self.openSession(driver)
+            with ThreadPoolExecutor(max_workers=max(self.maxWorkers, 1)) as executor:
+                missing = [currentDate for days in executor.map(self.exportDirect, windows) for currentDate in days]
+            self.closeSession()
+            # whatever the direct export could not deliver falls back to the browser
+            windows = self.groupWindows(missing)
+
+        if(self.browserWorkers <= 1):
+            self.exportWindows(driver, windows)
+            return
+
+        # the browser that is already logged in becomes worker 0, the others start their own
+        windowQueue = queue.Queue()
+        for window in windows:
+            windowQueue.put(window)
+        with ThreadPoolExecutor(max_workers=self.browserWorkers) as executor:
+            for index in range(self.browserWorkers):
+                executor.submit(self.runWorker, index, driver if index == 0 else None, windowQueue)
                 
+    def setOutputFormat(self, outputFormat):
+        self.outputFormat = outputFormat
+
+    def setQCRules(self, qcRules):
+        self.qcRules = qcRules
+
+    def parseTime(self, values):
+        for timeFormat in self.timeFormats:
+            try:
+                return pd.to_datetime(values, format=timeFormat)
+            except (ValueError, TypeError):
+                continue
+        raise ValueError("unknown time format: " + str(values.iloc[0]))
+
+    def readRaw(self, filename):
+        # raw exports have five columns, files cleaned by older versions start with an unnamed index column
+        # days of which only the parquet copy is left are read from it
+        if(filename.endswith(".parquet")):
+            df = pd.read_parquet(filename, columns=self.alsoNameList)
+            df['Time'] = df['Time'].dt.strftime("%Y-%m-%d %H:%M:%S")
+            return df
+        with open(filename, 'r') as f:
+            header = f.readline()
+        usecols = list(range(1, 6)) if header.startswith(',') else list(range(5))
+        dtype = {name: np.float32 for name in self.alsoNameList[1:]}
+        dtype['Time'] = str
+        return pd.read_csv(filename, thousands=',', header=0, usecols=usecols, names=self.alsoNameList, dtype=dtype)
+
     def cleanData(self, filename):
             
-        df = pd.read_csv(filename, thousands=',')
-    
-        # rename header
-        df.columns = self.alsoNameList   
+        df = self.readRaw(filename)
 
         # update time format
-        df['Time'] = pd.to_datetime(df['Time'], infer_datetime_format=True)
+        df['Time'] = self.parseTime(df['Time'])
 
         # fill Nan with preceding values
-        df = df.fillna(method='ffill', axis=0)
-        df.to_csv(filename)
+        df, flags = qc.QualityControl(self.qcRules, timeColumn='Time').apply(df)
+
+        name = os.path.splitext(filename)[0]
+        if(self.outputFormat in ['parquet', 'both']):
+            df.to_parquet(name + ".parquet", index=False)
+        if(self.outputFormat in ['csv', 'both']):
+            df.to_csv(name + ".csv", index=False, date_format="%Y-%m-%d %H:%M:%S")
+        return filename
+
+    def cleanDirectory(self, workers=None):
+        # re-clean every day of the archive in a process pool, from its csv or else from its parquet copy
+        files = set(file for file in os.listdir(self.path) if file.startswith('ae_') and file.endswith(('.csv', '.parquet')))
+        filenames = sorted(self.path + file for file in files if file.endswith('.csv') or file[:-8] + '.csv' not in files)
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for filename in executor.map(self.cleanData, filenames, chunksize=16):
+                pass
+        print(len(filenames), "ae files cleaned")
+
+    def readFrame(self, filename, columns=None):
+        # parquet is preferred when both formats exist
+        if(os.path.isfile(filename + ".parquet")):
+            return pd.read_parquet(filename + ".parquet", columns=columns)
+        df = self.readRaw(filename + ".csv")
+        df['Time'] = self.parseTime(df['Time'])
+        return df if columns is None else df[columns]
+
+    def readDay(self, currentDate, columns=None):
+        return self.readFrame(self.path + 'ae_' + currentDate.strftime("%Y-%m-%d"), columns)
 
     '''
 128     df = pd.read_csv(alsoenergyPath+filename,thousands=',')
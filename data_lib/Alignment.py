@@ -0,0 +1,82 @@
+import numpy as np
+import pandas as pd
+
+# every source is put on a tz-aware index in the local time of the site
+timezone = 'US/Eastern'
+
+def localizeTime(times, keys=None, timezone=timezone):
+    # files keep naive local times, the repeated hour of the DST change is told apart by order:
+    # the first occurrence of a time (per device) is daylight time, the second one standard time
+    times = pd.Series(pd.to_datetime(times)).reset_index(drop=True)
+    columns = {'time': times}
+    if(keys is not None):
+        columns['key'] = pd.Series(keys).reset_index(drop=True)
+    first = ~pd.DataFrame(columns).duplicated().values
+    return pd.DatetimeIndex(times.dt.tz_localize(timezone, ambiguous=first, nonexistent='shift_forward'), name='time')
+
+def indexFrame(df, timeColumn='time', keyColumn=None, timezone=timezone):
+    # the time column becomes a sorted tz-aware index, a device column (if any) stays a column
+    keys = None if keyColumn is None else df[keyColumn]
+    index = localizeTime(df[timeColumn], keys, timezone)
+    indexed = df.drop(columns=timeColumn).set_axis(index, axis=0)
+    return indexed.sort_index(kind='stable')
+
+def indexTMY(df, timezone=timezone, offset=-5):
+    # NSRDB rows are stamped in local standard time without DST
+    times = pd.to_datetime(df[['Year', 'Month', 'Day', 'Hour', 'Minute']].rename(columns=str.lower))
+    index = pd.DatetimeIndex(times.dt.tz_localize('Etc/GMT%+d' % -offset).dt.tz_convert(timezone), name='time')
+    return df.drop(columns=['Year', 'Month', 'Day', 'Hour', 'Minute']).set_axis(index, axis=0).sort_index(kind='stable')
+
+def composeGrid(index, interval):
+    return pd.date_range(index.min().floor(interval), index.max().floor(interval), freq=interval, name='time')
+
+def resampleFrame(df, interval, method='mean', keyColumn=None):
+    # numeric columns follow method ('mean', 'last' or 'interpolate'), other columns keep their last value
+    if(keyColumn is not None):
+        frames = []
+        for key, group in df.groupby(keyColumn, sort=True):
+            frame = resampleFrame(group.drop(columns=keyColumn), interval, method)
+            frame[keyColumn] = key
+            frames.append(frame)
+        return pd.concat(frames).sort_index(kind='stable')
+
+    numeric = df.select_dtypes(include='number').columns
+    others = df.columns.difference(numeric, sort=False)
+    if(method == 'interpolate'):
+        grid = composeGrid(df.index, interval)
+        # duplicated times are averaged first, values between two readings are interpolated in time
+        values = df[numeric].groupby(level=0).mean()
+        values = values.reindex(values.index.union(grid)).interpolate(method='time', limit_area='inside').reindex(grid)
+        if(len(others) > 0):
+            last = df[others].groupby(level=0).last()
+            values = values.join(last.reindex(last.index.union(grid)).ffill().reindex(grid))
+        return values[df.columns]
+
+    aggregation = {column: method for column in numeric}
+    aggregation.update({column: 'last' for column in others})
+    return df.resample(interval).agg(aggregation)[df.columns]
+
+def asofJoin(left, right, tolerance='90min', direction='backward', prefix=''):
+    # irregular observations (WS at :56) are matched to the closest earlier reading within tolerance
+    right = right.add_prefix(prefix).sort_index(kind='stable')
+    right.index = right.index.rename('time')
+    left = left.sort_index(kind='stable')
+    joined = pd.merge_asof(left.reset_index(), right.reset_index(), on='time', tolerance=pd.Timedelta(tolerance), direction=direction)
+    return joined.set_index('time')
+
+def alignSources(base, others, interval, keyColumn=None, baseMethod='mean'):
+    # base is resampled to interval (per device), every other source is joined on the same index
+    # others: list of (frame, prefix, method), method is 'mean', 'last', 'interpolate' or 'asof'
+    aligned = resampleFrame(base, interval, baseMethod, keyColumn)
+    for frame, prefix, method in others:
+        if(method == 'asof'):
+            aligned = asofJoin(aligned, frame, prefix=prefix)
+        else:
+            aligned = aligned.join(resampleFrame(frame, interval, method).add_prefix(prefix))
+    return aligned
+
+def splitDays(df, timeColumn=None):
+    # day by day slices by calendar date instead of by position, a missing row no longer shifts the days after it
+    times = df.index if timeColumn is None else pd.to_datetime(df[timeColumn])
+    dates = pd.Series(np.asarray(pd.DatetimeIndex(times).date), index=df.index)
+    return df.groupby(dates.values, sort=True)
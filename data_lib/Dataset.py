@@ -0,0 +1,129 @@
+# conda install pyarrow
+import os
+import sys
+import json
+import threading
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from data_lib import Loader as loader
+
+
+class Dataset:
+
+    # every source is stored as <datasetPath>/source=<source>/year=<yyyy>/month=<m>/data.parquet
+    # rows are sorted by device and time, so row group statistics let a reader skip other devices and days
+    rowGroupSize = 2016
+    timeColumns = {'ae': 'Time'}
+
+    def __init__(self, datasetPath):
+        self.datasetPath = datasetPath
+        self.manifestFile = os.path.join(datasetPath, "manifest.json")
+        self.lock = threading.Lock()
+
+    def getTimeColumn(self, source):
+        return self.timeColumns.get(source, 'time')
+
+    def loadManifest(self):
+        # days already compacted, per source
+        if(not os.path.isfile(self.manifestFile)):
+            return dict()
+        with open(self.manifestFile, 'r') as f:
+            return json.load(f)
+
+    def saveManifest(self, manifest):
+        os.makedirs(self.datasetPath, exist_ok=True)
+        tmp_file = self.manifestFile + ".tmp"
+        with open(tmp_file, 'w') as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+        os.replace(tmp_file, self.manifestFile)
+
+    def composePartition(self, source, year, month):
+        return os.path.join(self.datasetPath, "source=" + source, "year=" + str(year), "month=" + str(month))
+
+    def typeDay(self, df, source):
+        # a plain integer deviceID keeps min/max statistics usable for pushdown
+        if('deviceID' in df.columns):
+            df['deviceID'] = df['deviceID'].astype(str).astype('int16')
+        return df
+
+    def writePartition(self, source, year, month, df):
+        partition = self.composePartition(source, year, month)
+        os.makedirs(partition, exist_ok=True)
+        keys = [column for column in ['deviceID', self.getTimeColumn(source)] if column in df.columns]
+        df = df.sort_values(keys, kind='stable').reset_index(drop=True)
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        tmp_file = os.path.join(partition, "data.parquet.tmp")
+        pq.write_table(table, tmp_file, row_group_size=self.rowGroupSize)
+        os.replace(tmp_file, os.path.join(partition, "data.parquet"))
+
+    def compact(self, source, path=None, workers=8):
+        # only days that are not in the dataset yet are read, each touched month is rewritten once
+        with self.lock:
+            manifest = self.loadManifest()
+            done = set(manifest.get(source, []))
+            days = [day for day in loader.listDays(source, path) if day.strftime("%Y-%m-%d") not in done]
+            if(len(days) == 0):
+                print(source, "dataset up to date")
+                return 0
+
+            months = dict()
+            for day in days:
+                months.setdefault((day.year, day.month), []).append(day)
+
+            rows = 0
+            for (year, month), month_days in sorted(months.items()):
+                new_df = loader.loadDays(source, month_days, typed=True, workers=workers, path=path)
+                # unreadable days are tried again by the next compaction
+                missing = new_df.attrs.get('missing', [])
+                if(len(new_df) > 0):
+                    rows = rows + len(new_df)
+                    new_df = self.typeDay(new_df, source)
+                    filename = os.path.join(self.composePartition(source, year, month), "data.parquet")
+                    if(os.path.isfile(filename)):
+                        new_df = pd.concat([pd.read_parquet(filename), new_df], ignore_index=True)
+                    self.writePartition(source, year, month, new_df)
+
+                done.update(day.strftime("%Y-%m-%d") for day in month_days if day not in missing)
+                manifest[source] = sorted(done)
+                self.saveManifest(manifest)
+                print(source, year, month, len(month_days), "days compacted")
+            return rows
+
+    def composeFilter(self, source, schema, start=None, end=None, deviceID=None):
+        # partitions outside [start, end] are pruned by year/month, rows by time and deviceID statistics
+        time_column = self.getTimeColumn(source)
+        time_type = schema.field(time_column).type
+        expression = None
+        conditions = []
+        if(start is not None):
+            start = pd.Timestamp(start)
+            conditions.append((ds.field('year') > start.year) | ((ds.field('year') == start.year) & (ds.field('month') >= start.month)))
+            conditions.append(ds.field(time_column) >= pa.scalar(start.to_pydatetime(), time_type))
+        if(end is not None):
+            end = pd.Timestamp(end)
+            conditions.append((ds.field('year') < end.year) | ((ds.field('year') == end.year) & (ds.field('month') <= end.month)))
+            conditions.append(ds.field(time_column) <= pa.scalar(end.to_pydatetime(), time_type))
+        if(deviceID is not None):
+            devices = deviceID if isinstance(deviceID, (list, tuple, set)) else [deviceID]
+            conditions.append(ds.field('deviceID').isin([int(device) for device in devices]))
+        for condition in conditions:
+            expression = condition if expression is None else expression & condition
+        return expression
+
+    def read(self, source, start=None, end=None, deviceID=None, columns=None):
+        # end is inclusive, e.g. read('sp_operating', '2023-07-01', '2023-07-31 23:59:59', deviceID=30)
+        folder = os.path.join(self.datasetPath, "source=" + source)
+        if(not os.path.isdir(folder)):
+            return pd.DataFrame(columns=columns)
+        dataset = ds.dataset(folder, format='parquet', partitioning='hive')
+        if(columns is None):
+            columns = [name for name in dataset.schema.names if name not in ['year', 'month']]
+        table = dataset.to_table(columns=columns, filter=self.composeFilter(source, dataset.schema, start, end, deviceID))
+        df = table.to_pandas()
+        time_column = self.getTimeColumn(source)
+        keys = [column for column in [time_column, 'deviceID'] if column in df.columns]
+        return df.sort_values(keys, kind='stable').reset_index(drop=True) if len(keys) > 0 else df
@@ -0,0 +1,87 @@
+import os
+import sys
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import pandas as pd
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.append(root)
+
+# daily archives: data folder and the reader of every source
+sources = {
+    'sp_operating': os.path.join(root, 'sp', 'sp_data') + os.sep,
+    'sp_environmental': os.path.join(root, 'sp', 'sp_data') + os.sep,
+    'ae': os.path.join(root, 'ae', 'ae_data') + os.sep,
+    'ws': os.path.join(root, 'ws', 'ws_data') + os.sep
+}
+
+# file name prefix of every source inside its data folder
+prefixes = {
+    'sp_operating': 'operating' + os.sep + 'sp_',
+    'sp_environmental': 'environmental' + os.sep + 'sp_',
+    'ae': 'ae_',
+    'ws': 'ws_'
+}
+
+def listDays(source, path=None):
+    # days with a csv or parquet file in the archive
+    path = path or sources[source]
+    folder, prefix = os.path.split(path + prefixes[source])
+    days = set()
+    for file in os.listdir(folder):
+        name, extension = os.path.splitext(file)
+        if(file.startswith(prefix) and extension in ['.csv', '.parquet']):
+            days.add(datetime.strptime(name[len(prefix):], "%Y-%m-%d"))
+    return sorted(days)
+
+def createReader(source, path):
+    # providers are imported on first use, loading SP or WS data does not need selenium
+    if(source in ['sp_operating', 'sp_environmental']):
+        from sp import SunnyPortal as sp
+        return sp.SunnyPortal(path)
+    if(source == 'ae'):
+        from ae import AlsoEnergy as ae
+        return ae.AlsoEnergy(path, None, None)
+    if(source == 'ws'):
+        from ws import WeatherStation as ws
+        return ws.WeatherStation(path, None)
+    raise ValueError("unknown source: " + source)
+
+def readDay(source, path, currentDate, columns=None, typed=False):
+    # returns the frame of one day, or the reason it could not be read
+    reader = createReader(source, path)
+    try:
+        if(source == 'sp_operating'):
+            return reader.readOperating(currentDate, typed, columns), None
+        if(source == 'sp_environmental'):
+            return reader.readEnvironmental(currentDate, typed, columns), None
+        return reader.readDay(currentDate, columns), None
+    except FileNotFoundError:
+        return None, "missing"
+    except Exception as e:
+        return None, "unreadable: " + str(e)
+
+def loadDays(source, days, columns=None, typed=False, workers=8, processes=False, path=None):
+    # reads the given days concurrently and returns one frame, days that cannot be read are reported
+    path = path or sources[source]
+    Executor = ProcessPoolExecutor if processes else ThreadPoolExecutor
+    with Executor(max_workers=max(workers, 1)) as executor:
+        results = list(executor.map(readDay, [source]*len(days), [path]*len(days), days, [columns]*len(days), [typed]*len(days)))
+
+    frames = [df for df, error in results if df is not None]
+    skipped = [(currentDate, error) for currentDate, (df, error) in zip(days, results) if df is None]
+    for currentDate, error in skipped:
+        print(source, currentDate.strftime("%Y-%m-%d"), error)
+    print(source, len(days) - len(skipped), "of", len(days), "days loaded")
+
+    if(len(frames) == 0):
+        df = pd.DataFrame(columns=columns)
+    else:
+        df = pd.concat(frames, ignore_index=True)
+    df.attrs['missing'] = [currentDate for currentDate, error in skipped]
+    return df
+
+def loadRange(source, start, end, columns=None, typed=False, workers=8, processes=False, path=None):
+    # every day of [start, end]
+    days = [start + timedelta(days=i) for i in range((end - start).days + 1)]
+    return loadDays(source, days, columns, typed, workers, processes, path)
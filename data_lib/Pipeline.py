@@ -0,0 +1,126 @@
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from data_lib import Loader as loader
+from data_lib import QualityControl as qc
+from data_lib import Alignment as alignment
+
+
+class Pipeline:
+
+    # load -> QC -> align -> insert, one block of days at a time
+    chunkMonths = 1
+    # peak memory of a block in bytes, None for whole blocks
+    memoryBudget = None
+    # QC and alignment hold a few copies of a block at once
+    overhead = 3
+    workers = 8
+
+    def __init__(self):
+        self.sources = dict()
+        self.alignment = None
+        self.inserts = dict()
+        self.bytesPerDay = 0
+
+    def setChunkMonths(self, chunkMonths):
+        self.chunkMonths = chunkMonths
+
+    def setMemoryBudget(self, memoryBudget):
+        self.memoryBudget = memoryBudget
+
+    def setWorkers(self, workers):
+        self.workers = workers
+
+    def addSource(self, name, source, rules=None, tmy=None, keyColumn=None, timeColumn='time', columns=None, path=None):
+        self.sources[name] = {'source': source, 'rules': rules, 'tmy': tmy, 'keyColumn': keyColumn, 'timeColumn': timeColumn, 'columns': columns, 'path': path}
+
+    def setAlignment(self, base, others, interval):
+        # others: list of (name, prefix, method) as in Alignment.alignSources
+        self.alignment = {'base': base, 'others': others, 'interval': interval}
+
+    def addInsert(self, name, function):
+        # function(df) is called with every block of a source, or of 'aligned'
+        self.inserts[name] = function
+
+    def downcast(self, df, timeColumn):
+        # float32 measurements, small integers, parsed timestamps and categorical text
+        for column in df.columns:
+            values = df[column]
+            if(column == timeColumn):
+                if(not pd.api.types.is_datetime64_any_dtype(values)):
+                    df[column] = pd.to_datetime(values, format="%Y-%m-%d %H:%M:%S")
+            elif(pd.api.types.is_float_dtype(values)):
+                df[column] = values.astype(np.float32)
+            elif(pd.api.types.is_integer_dtype(values)):
+                df[column] = pd.to_numeric(values, downcast='integer')
+            elif(not isinstance(values.dtype, pd.CategoricalDtype)):
+                df[column] = values.astype('category')
+        return df
+
+    def composeChunks(self, start, end):
+        # calendar blocks of chunkMonths months
+        chunks = []
+        chunk_start = start
+        while(chunk_start <= end):
+            month = chunk_start.month - 1 + self.chunkMonths
+            chunk_end = datetime(chunk_start.year + month // 12, month % 12 + 1, 1) - timedelta(days=1)
+            chunks.append([chunk_start + timedelta(days=i) for i in range((min(chunk_end, end) - chunk_start).days + 1)])
+            chunk_start = chunk_end + timedelta(days=1)
+        return chunks
+
+    def composeBlockSize(self, remaining):
+        # the number of days the budget allows, learnt from the blocks before; the first block is a single day
+        if(self.memoryBudget is None):
+            return remaining
+        if(self.bytesPerDay == 0):
+            return 1
+        return max(1, min(remaining, int(self.memoryBudget // (self.overhead * self.bytesPerDay))))
+
+    def processBlock(self, days):
+        frames = dict()
+        for name, config in self.sources.items():
+            df = loader.loadDays(config['source'], days, config['columns'], False, self.workers, False, config['path'])
+            if(len(df) == 0):
+                continue
+            df = self.downcast(df, config['timeColumn'])
+            if(config['rules'] is not None):
+                df, flags = qc.QualityControl(config['rules'], config['tmy'], keyColumn=config['keyColumn'], timeColumn=config['timeColumn']).apply(df)
+            frames[name] = df
+
+        size = sum(df.memory_usage(deep=True).sum() for df in frames.values())
+        self.bytesPerDay = max(self.bytesPerDay, size / len(days))
+
+        if(self.alignment is not None and self.alignment['base'] in frames):
+            base = self.sources[self.alignment['base']]
+            others = []
+            for name, prefix, method in self.alignment['others']:
+                if(name in frames):
+                    others.append((alignment.indexFrame(frames[name], self.sources[name]['timeColumn']), prefix, method))
+            indexed = alignment.indexFrame(frames[self.alignment['base']], base['timeColumn'], base['keyColumn'])
+            frames['aligned'] = alignment.alignSources(indexed, others, self.alignment['interval'], base['keyColumn'])
+
+        for name, function in self.inserts.items():
+            if(name in frames):
+                function(frames[name])
+        return sum(len(df) for name, df in frames.items() if name != 'aligned'), size
+
+    def run(self, start, end):
+        rows = 0
+        peak = 0
+        start_time = time.time()
+        for chunk in self.composeChunks(start, end):
+            i = 0
+            while(i < len(chunk)):
+                block = chunk[i:i + self.composeBlockSize(len(chunk) - i)]
+                block_rows, size = self.processBlock(block)
+                rows = rows + block_rows
+                peak = max(peak, size)
+                i = i + len(block)
+                print(block[0].strftime("%Y-%m-%d"), "to", block[-1].strftime("%Y-%m-%d"), block_rows, "rows,", round(size/2**20, 1), "MB")
+        print(rows, "rows processed in", round(time.time() - start_time, 1), "s, largest block", round(peak/2**20, 1), "MB")
+        return rows
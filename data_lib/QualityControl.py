@@ -0,0 +1,152 @@
+import os
+import sys
+import operator
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from data_lib import Alignment as alignment
+
+# flag bits of every checked cell
+SENTINEL = 1    # sentinel value replaced
+CROSS = 2       # set by a cross-column rule
+BELOW = 4       # below the lower bound, removed
+ABOVE = 8       # above the upper bound, removed
+FILLED = 16     # filled from the preceding value
+MISSING = 32    # still missing after filling
+
+operators = {'==': operator.eq, '!=': operator.ne, '<': operator.lt, '<=': operator.le, '>': operator.gt, '>=': operator.ge}
+
+# Rule sets, applied in this order:
+#   cross:     [{'when': (column, op, value), 'set': {column: value}}], evaluated on the values before any other rule
+#   sentinels: {column: {sentinel: replacement}}
+#   bounds:    {column: (min, max)} or {column: TMY column} for bounds taken from the TMY reference
+#   fill:      {column: maximum gap in rows, None for no limit}, gaps longer than the maximum stay missing
+sp_operating_rules = {
+    'cross': [{'when': ('ac_power', '==', -1), 'set': {'dc_power_a': 0.0, 'dc_power_b': 0.0}}],
+    'sentinels': {'ac_power': {-1: 0.0}}
+}
+
+sp_environmental_rules = {
+    'sentinels': {'ir': {-1: 0.0}},
+    'bounds': {'ir': 'GHI', 'ambient_temp2': 'Temperature', 'ambient_rh': 'Relative Humidity'},
+    'fill': {'ir': None, 'ambient_temp2': None, 'ambient_rh': None}
+}
+
+ae_rules = {
+    'bounds': {'GHI': 'GHI'},
+    'fill': {'GHI': None}
+}
+
+# AlsoEnergy.cleanData fills every measurement of a download
+ae_clean_rules = {
+    'fill': {'GHI': None, 'POA': None, 'ambient_temp': None, 'module_temp': None}
+}
+
+
+class QualityControl:
+
+    def __init__(self, rules, tmy=None, hourly=False, keyColumn=None, timeColumn='time'):
+        # hourly: TMY bounds per month and hour of day instead of the global extremes
+        self.rules = rules
+        self.tmy = tmy
+        self.hourly = hourly
+        self.keyColumn = keyColumn
+        self.timeColumn = timeColumn
+
+    def listColumns(self):
+        columns = []
+        for rule in self.rules.get('cross', []):
+            columns = columns + list(rule['set'].keys())
+        for kind in ['sentinels', 'bounds', 'fill']:
+            columns = columns + list(self.rules.get(kind, dict()).keys())
+        return list(dict.fromkeys(columns))
+
+    def composeBounds(self, df, bound):
+        if(not isinstance(bound, str)):
+            return bound
+        if(self.tmy is None):
+            raise ValueError("bounds from " + bound + " need a TMY reference")
+        if(not self.hourly):
+            return self.tmy.getGlobalBounds(bound)
+        times = df[self.timeColumn]
+        if(not pd.api.types.is_datetime64_any_dtype(times)):
+            times = pd.to_datetime(times, format="%Y-%m-%d %H:%M:%S")
+        if(getattr(times.dt, 'tz', None) is None):
+            # files keep local wall-clock times, during DST they are an hour ahead of the TMY standard time
+            keys = None if self.keyColumn is None else df[self.keyColumn]
+            times = alignment.localizeTime(times, keys)
+        return self.tmy.lookupBounds(bound, times)
+
+    def composeOrder(self, df):
+        # rows of one device are filled from each other only, in their original order
+        if(self.keyColumn is None):
+            return None, np.zeros(len(df), dtype=bool)
+        keys = df[self.keyColumn].to_numpy()
+        order = np.argsort(keys, kind='stable')
+        starts = np.ones(len(df), dtype=bool)
+        starts[1:] = keys[order][1:] != keys[order][:-1]
+        return order, starts
+
+    def fillColumn(self, values, limit, order, starts):
+        sorted_values = values if order is None else values[order]
+        valid = ~np.isnan(sorted_values)
+        breaks = valid | starts
+        if(len(breaks) > 0):
+            breaks[0] = True
+        positions = np.arange(len(sorted_values))
+        last = np.maximum.accumulate(np.where(breaks, positions, 0))
+        filled = sorted_values[last]
+        if(limit is not None):
+            # length of every gap, a gap longer than limit is not filled at all
+            run = np.cumsum(breaks) - 1
+            gap = np.bincount(run, weights=~valid) if len(run) > 0 else np.zeros(0)
+            filled = np.where(~valid & (gap[run] > limit), np.nan, filled)
+        if(order is None):
+            return filled
+        result = np.empty_like(filled)
+        result[order] = filled
+        return result
+
+    def apply(self, df):
+        # returns the cleaned frame and a uint8 flag frame for the checked columns
+        cleaned = df.copy()
+        columns = self.listColumns()
+        flags = pd.DataFrame(0, index=df.index, columns=columns, dtype=np.uint8)
+        values = dict()
+        for column in columns:
+            array = cleaned[column].to_numpy(copy=True)
+            values[column] = array if array.dtype.kind == 'f' else array.astype(np.float64)
+
+        for rule in self.rules.get('cross', []):
+            column, op, value = rule['when']
+            mask = operators[op](df[column].to_numpy(), value)
+            for target, replacement in rule['set'].items():
+                values[target][mask] = replacement
+                flags[target] = flags[target].to_numpy() | np.where(mask, CROSS, 0).astype(np.uint8)
+
+        for column, mapping in self.rules.get('sentinels', dict()).items():
+            original = df[column].to_numpy()
+            for sentinel, replacement in mapping.items():
+                mask = original == sentinel
+                values[column][mask] = replacement
+                flags[column] = flags[column].to_numpy() | np.where(mask, SENTINEL, 0).astype(np.uint8)
+
+        for column, bound in self.rules.get('bounds', dict()).items():
+            lower, upper = self.composeBounds(df, bound)
+            with np.errstate(invalid='ignore'):
+                below = values[column] < lower
+                above = values[column] > upper
+            values[column][below | above] = np.nan
+            flags[column] = flags[column].to_numpy() | np.where(below, BELOW, 0).astype(np.uint8) | np.where(above, ABOVE, 0).astype(np.uint8)
+
+        order, starts = self.composeOrder(df)
+        for column, limit in self.rules.get('fill', dict()).items():
+            missing = np.isnan(values[column])
+            values[column] = self.fillColumn(values[column], limit, order, starts)
+            still_missing = np.isnan(values[column])
+            flags[column] = flags[column].to_numpy() | np.where(missing & ~still_missing, FILLED, 0).astype(np.uint8) | np.where(still_missing, MISSING, 0).astype(np.uint8)
+
+        for column in columns:
+            cleaned[column] = values[column]
+        return cleaned, flags
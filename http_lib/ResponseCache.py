@@ -0,0 +1,81 @@
+import os
+import gzip
+import json
+import hashlib
+import threading
+
+
+class ResponseCache:
+
+    # raw API responses stored as gzip JSON under <cachePath>/<provider>/<begin>_<end>_<hash>.json.gz
+    def __init__(self, cachePath, maxSize=None):
+        self.cachePath = cachePath
+        self.maxSize = maxSize
+        self.lock = threading.Lock()
+        self.size = 0
+        if(os.path.isdir(self.cachePath)):
+            self.size = sum(size for filename, size, mtime in self.listFiles())
+
+    def setMaxSize(self, maxSize):
+        self.maxSize = maxSize
+        self.evict()
+
+    def getSize(self):
+        return self.size
+
+    def composeFilename(self, provider, endpoint, payloads, begin, end):
+        # the request itself is the address, the window only makes the file easy to find
+        content = json.dumps({'endpoint': endpoint, 'payloads': payloads}, sort_keys=True)
+        digest = hashlib.sha256(content.encode('utf-8')).hexdigest()[:32]
+        window = "".join(c for c in str(begin) + "_" + str(end) if c.isalnum() or c in "-_")
+        return os.path.join(self.cachePath, provider, window + "_" + digest + ".json.gz")
+
+    def get(self, provider, endpoint, payloads, begin, end):
+        filename = self.composeFilename(provider, endpoint, payloads, begin, end)
+        if(not os.path.isfile(filename)):
+            return None
+        try:
+            with gzip.open(filename, 'rt', encoding='utf-8') as f:
+                response = json.load(f)
+            # touch the file so eviction drops the least recently used responses first
+            os.utime(filename)
+            return response
+        except Exception as e:
+            print(filename, " cache read failed: ", e)
+            return None
+
+    def put(self, provider, endpoint, payloads, begin, end, response):
+        filename = self.composeFilename(provider, endpoint, payloads, begin, end)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        tmp_file = filename + "." + str(threading.get_ident()) + ".tmp"
+        with gzip.open(tmp_file, 'wt', encoding='utf-8') as f:
+            json.dump(response, f)
+        with self.lock:
+            if(os.path.isfile(filename)):
+                self.size = self.size - os.path.getsize(filename)
+            os.replace(tmp_file, filename)
+            self.size = self.size + os.path.getsize(filename)
+        self.evict()
+
+    def listFiles(self):
+        files = []
+        for root, dirs, filenames in os.walk(self.cachePath):
+            for filename in filenames:
+                if(filename.endswith(".json.gz")):
+                    stat = os.stat(os.path.join(root, filename))
+                    files.append((os.path.join(root, filename), stat.st_size, stat.st_mtime))
+        return files
+
+    def evict(self):
+        with self.lock:
+            if(self.maxSize is None or self.size <= self.maxSize):
+                return
+            self.size = 0
+            full = False
+            files = sorted(self.listFiles(), key=lambda f: f[2], reverse=True)
+            for filename, size, mtime in files:
+                if(not full and self.size + size <= self.maxSize):
+                    self.size = self.size + size
+                else:
+                    full = True
+                    os.remove(filename)
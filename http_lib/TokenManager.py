@@ -0,0 +1,129 @@
+import os
+import json
+import time
+import threading
+import requests
+
+
+class TokenManager:
+
+    # OpenID tokens are refreshed this many seconds before they expire
+    refreshMargin = 60
+
+    # private properties
+    __username = ''
+    __password = ''
+
+    def __init__(self, tokenUrl, clientId, header=None, cacheFile=None):
+        self.tokenUrl = tokenUrl
+        self.clientId = clientId
+        self.header = header
+        self.cacheFile = cacheFile
+        self.session = None
+        self.token = None
+        # access tokens the server rejected, a cache still holding one of them is not used
+        self.rejected = set()
+        self.lock = threading.Lock()
+
+    def setUserName(self, username):
+        self.__username = username
+
+    def setPassword(self, password):
+        self.__password = password
+
+    def setCacheFile(self, cacheFile):
+        self.cacheFile = cacheFile
+
+    def setSession(self, session):
+        self.session = session
+
+    def post(self, payloads):
+        if(self.session is None):
+            return requests.post(self.tokenUrl, headers=self.header, data=payloads)
+        return self.session.post(self.tokenUrl, headers=self.header, data=payloads)
+
+    def loadToken(self):
+        if(self.cacheFile is None or not os.path.isfile(self.cacheFile)):
+            return None
+        try:
+            with open(self.cacheFile, 'r') as f:
+                token = json.load(f)
+        except Exception as e:
+            print("Token cache unreadable: ", e)
+            return None
+        # a cache written for another account is ignored
+        if(token.get('username') != self.__username):
+            return None
+        return token
+
+    def saveToken(self, token):
+        if(self.cacheFile is None):
+            return
+        # write to a private temporary file first so other processes never read a partial cache
+        tmp_file = self.cacheFile + "." + str(os.getpid()) + ".tmp"
+        fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(token, f)
+        os.replace(tmp_file, self.cacheFile)
+
+    def requestToken(self, payloads):
+        now = time.time()
+        response = self.post(payloads)
+        if(response.status_code != 200):
+            return None
+        content = json.loads(response.text)
+        return {
+            'username': self.__username,
+            'access_token': content['access_token'],
+            'access_expiry': now + content.get('expires_in', 0),
+            'refresh_token': content.get('refresh_token'),
+            'refresh_expiry': now + content.get('refresh_expires_in', 0)
+        }
+
+    def login(self):
+        return self.requestToken({
+            'grant_type': 'password',
+            'username': self.__username,
+            'password': self.__password,
+            'client_id' : self.clientId
+        })
+
+    def refresh(self, token):
+        return self.requestToken({
+            'grant_type': 'refresh_token',
+            'refresh_token': token['refresh_token'],
+            'client_id' : self.clientId
+        })
+
+    def isValid(self, token, key):
+        return token is not None and token.get(key + '_token') is not None and token[key + '_expiry'] - self.refreshMargin > time.time()
+
+    def invalidate(self):
+        with self.lock:
+            if(self.token is not None):
+                self.rejected.add(self.token['access_token'])
+                self.token['access_expiry'] = 0
+
+    def getAccessToken(self):
+        with self.lock:
+            if(self.isValid(self.token, 'access')):
+                return self.token['access_token']
+
+            # another worker or process may have refreshed the cache already
+            cached = self.loadToken()
+            if(self.isValid(cached, 'access') and cached['access_token'] not in self.rejected):
+                self.token = cached
+                return self.token['access_token']
+
+            token = None
+            for candidate in [self.token, cached]:
+                if(token is None and self.isValid(candidate, 'refresh')):
+                    token = self.refresh(candidate)
+            if(token is None):
+                token = self.login()
+            if(token is None):
+                return None
+
+            self.token = token
+            self.saveToken(token)
+            return token['access_token']
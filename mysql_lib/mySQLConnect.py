@@ -1,18 +1,40 @@
 # conda install sqlalchemy
 # conda install -c anaconda mysql-connector-python
 # pip install mysqlclient
+import os
+import time
+import tempfile
 import mysql.connector as mysql
-from sqlalchemy import create_engine
+from mysql.connector import errorcode
+from sqlalchemy import create_engine, text, exc
+from sqlalchemy.engine import URL
+import pandas as pd
 import logging
 
+# pandas (multi-row to_sql) and SQLAlchemy wrap the errors of mysql.connector
+insertErrors = (mysql.Error, exc.DBAPIError, pd.errors.DatabaseError)
+
 class mySQLConnect:
 
+    # one pooled engine per object serves every read and write
+    poolSize = 5
+    maxOverflow = 5
+    # connections are checked before use and replaced before the server drops them
+    poolPrePing = True
+    poolRecycle = 3600
+    # rows per multi-row INSERT statement of the bulk path
+    chunkSize = 1000
+    # days committed per transaction by insertDays
+    batchDays = 31
+    # LOAD DATA LOCAL INFILE from a temporary csv, needs local_infile enabled on the server
+    loadData = False
+
     def __init__(self, username, password, database, host):
         self.username = username  
         self.password = password
         self.database = database
         self.host = host
-        self.connection = None
+        self.engine = None
         
     def getDatabase(self):
         return self.database 
@@ -20,43 +42,166 @@ class mySQLConnect:
     def getHost(self):
         return self.host 
 
+    def setPoolSize(self, poolSize, maxOverflow=None):
+        self.poolSize = poolSize
+        if(maxOverflow is not None):
+            self.maxOverflow = maxOverflow
+
+    def setPoolPrePing(self, poolPrePing):
+        self.poolPrePing = poolPrePing
+
+    def setPoolRecycle(self, poolRecycle):
+        self.poolRecycle = poolRecycle
+
+    def setChunkSize(self, chunkSize):
+        self.chunkSize = chunkSize
+
+    def setBatchDays(self, batchDays):
+        self.batchDays = batchDays
+
+    def setLoadData(self, loadData):
+        # the client side of local infile is a connect argument, so the pool is rebuilt
+        self.loadData = loadData
+        self.close()
+
+    def composeUrl(self):
+        # special characters of the password are escaped by URL.create
+        return URL.create('mysql+mysqlconnector', username=self.username, password=self.password, host=self.host, database=self.database)
+
+    def getEngine(self):
+        if(self.engine is None):
+            connect_args = {'allow_local_infile': True} if self.loadData else dict()
+            self.engine = create_engine(self.composeUrl(), pool_size=self.poolSize, max_overflow=self.maxOverflow, pool_pre_ping=self.poolPrePing, pool_recycle=self.poolRecycle, connect_args=connect_args)
+        return self.engine
+
     def connect(self):
         
         try:
-            connection = mysql.connect(
-                user = self.username,
-                password = self.password,
-                database = self.database,
-                host = self.host
-            )
-            self.connection = connection
+            with self.getEngine().connect() as connection:
+                connection.execute(text("SELECT 1"))
             print("Connection succeed!")
         except  Exception as e:
             logging.error('Connection failed: ' + str(e))
 
+    def close(self):
+        if(self.engine is not None):
+            self.engine.dispose()
+            self.engine = None
+
+    def __enter__(self):
+        self.connect()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
     def insert(self, df, table):
     
         flag = 0
         print("Insert", table)
         
         try:
-            engine = create_engine('mysql+mysqlconnector://'+self.username+':'+self.password+'@'+self.host+'/'+self.database)
-            df.to_sql(table,con=engine, if_exists='append',index=False)
+            df.to_sql(table,con=self.getEngine(), if_exists='append',index=False)
             flag = 1
             print("Insert Succeed!")
 
-        except mysql.Error as err:
+        except insertErrors as err:
             print("Insert Error!")
             flag = -1
-            if err.errno == errorcode.ER_ACCESS_DENIED_ERROR:
-                print("Something is wrong with your user name or password")
-            elif err.errno == errorcode.ER_BAD_DB_ERROR:
-                print("Database does not exist")
-            else:
-                print(err)
+            self.printError(err)
         finally:
             return flag
 
+    def printError(self, err):
+        # unwrap to the mysql error, which carries the errno
+        while(getattr(err, 'errno', None) is None and (getattr(err, 'orig', None) or err.__cause__) is not None):
+            err = getattr(err, 'orig', None) or err.__cause__
+        if getattr(err, 'errno', None) == errorcode.ER_ACCESS_DENIED_ERROR:
+            print("Something is wrong with your user name or password")
+        elif getattr(err, 'errno', None) == errorcode.ER_BAD_DB_ERROR:
+            print("Database does not exist")
+        else:
+            print(err)
+
+    def insertChunks(self, df, table, connection):
+        # one INSERT ... VALUES (...), (...) statement per chunkSize rows
+        df.to_sql(table, con=connection, if_exists='append', index=False, method='multi', chunksize=self.chunkSize)
+
+    def loadFile(self, df, table, connection):
+        # missing values are written as \N, which LOAD DATA reads as NULL
+        tmp = tempfile.NamedTemporaryFile(suffix=".csv", delete=False)
+        tmp.close()
+        try:
+            df = df.copy()
+            for column in df.columns:
+                if(pd.api.types.is_bool_dtype(df[column])):
+                    df[column] = df[column].astype('Int8')
+            df.to_csv(tmp.name, index=False, header=False, na_rep='\\N', date_format="%Y-%m-%d %H:%M:%S", lineterminator='\n')
+            columns = ", ".join("`" + column + "`" for column in df.columns)
+            filename = tmp.name.replace("\\", "/")
+            connection.exec_driver_sql("LOAD DATA LOCAL INFILE '" + filename + "' INTO TABLE `" + table + "` FIELDS TERMINATED BY ',' OPTIONALLY ENCLOSED BY '\"' LINES TERMINATED BY '\\n' (" + columns + ")")
+        finally:
+            os.remove(tmp.name)
+
+    def writeFrame(self, df, table, connection):
+        if(self.loadData):
+            self.loadFile(df, table, connection)
+        else:
+            self.insertChunks(df, table, connection)
+
+    def printRate(self, table, rows, start_time):
+        seconds = max(time.time() - start_time, 1e-6)
+        print(table, rows, "rows inserted in", round(seconds, 1), "s,", int(rows / seconds), "rows/s")
+
+    def insertBulk(self, df, table):
+        # one frame in one transaction, returns the number of rows or -1
+        start_time = time.time()
+        try:
+            with self.getEngine().begin() as connection:
+                self.writeFrame(df, table, connection)
+        except insertErrors as err:
+            print("Insert Error!")
+            self.printError(err)
+            return -1
+        self.printRate(table, len(df), start_time)
+        return len(df)
+
+    def insertDays(self, frames, table):
+        # frames: (day, df) pairs, e.g. Alignment.splitDays; batchDays days are committed together
+        # returns the number of rows, or -1 when a batch fails: it is rolled back, the batches before it stay
+        # committed and the days that were not inserted are printed
+        start_time = time.time()
+        rows = 0
+        days = []
+        batch = []
+        frames = iter(frames)
+        try:
+            for day, df in frames:
+                days.append(day)
+                batch.append(df)
+                if(len(batch) >= self.batchDays):
+                    rows = rows + self.commitBatch(batch, table)
+                    days = []
+                    batch = []
+            if(len(batch) > 0):
+                rows = rows + self.commitBatch(batch, table)
+        except insertErrors as err:
+            print("Insert Error!")
+            self.printError(err)
+            days = days + [day for day, df in frames]
+            print(table, len(days), "days not inserted:", ", ".join(str(day)[:10] for day in days))
+            self.printRate(table, rows, start_time)
+            return -1
+        self.printRate(table, rows, start_time)
+        return rows
+
+    def commitBatch(self, batch, table):
+        df = pd.concat(batch, ignore_index=True)
+        with self.getEngine().begin() as connection:
+            self.writeFrame(df, table, connection)
+        return len(df)
+
 
     #def delete(self):
     #    pass
@@ -65,11 +210,16 @@ class mySQLConnect:
         
         try:
             # TODO: verify data format
-            cursor = self.connection.cursor()              
             if(query is not None):
-                cursor.execute(query)
-                myresult=cursor.fetchall()
+                with self.getEngine().connect() as connection:
+                    myresult=connection.execute(text(query)).fetchall()
                 print(myresult)
+                return myresult
                 
         except  Exception as e:
-            logging.error('Query failed: ' + str(e))
\ No newline at end of file
+            logging.error('Query failed: ' + str(e))
+
+    def read(self, query, params=None):
+        # query results as a DataFrame, on a connection of the same pool
+        with self.getEngine().connect() as connection:
+            return pd.read_sql(text(query), connection, params=params)
\ No newline at end of file
@@ -1,12 +1,23 @@
+# conda install pyarrow (only for the parquet output format)
 import os
 import time
 from datetime import date, timedelta, datetime
+import numpy as np
 import pandas as pd
 from bs4 import BeautifulSoup
 import requests
 import json
+import bisect
+from concurrent.futures import ThreadPoolExecutor
 import pytz
 import pdb
+import sys
+import threading
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from http_lib import RateLimiter as rate_limiter
+from http_lib import TokenManager as token_manager
+from http_lib import ResponseCache as response_cache
 
 class SunnyPortal:
  
@@ -52,18 +63,49 @@ class SunnyPortal:
 
     access_token = ''
 
+    # concurrent requests
+    maxWorkers = 4
+    session = None
+
+    # number of days requested per measurements/search call
+    daysPerRequest = 1
+
+    # put every device of a day into one query, split when it exceeds maxQueryItems
+    coalesceDevices = False
+    maxQueryItems = 100
+
+    # backfill workers, request rate limit and the progress log used to resume interrupted runs
+    backfillWorkers = 1
+    rateLimiter = None
+    progressFile = 'progress.txt'
+    unfinished = set()
+    lock = threading.Lock()
+
+    # raw responses cache, replay rebuilds the daily files from it without calling the API
+    responseCache = None
+    replay = False
+
+    # daily files are written as 'csv', 'parquet' or 'both'
+    outputFormat = 'csv'
+
     # private properties
     __username = ''
     __password = ''
 
     def __init__(self, path):
         self.path = path
+        self.tokenManager = token_manager.TokenManager(self.login_url, 'SPpbeOS', self.login_header)
 
     def setUserName(self, username):
         self.__username = username
+        self.tokenManager.setUserName(username)
 
     def setPassword(self, password):
         self.__password = password
+        self.tokenManager.setPassword(password)
+
+    def setTokenCache(self, cacheFile):
+        self.tokenManager.setCacheFile(cacheFile)
 
     def setStartDate(self, startDate):
         self.startDate = startDate
@@ -139,116 +181,140 @@ class SunnyPortal:
         return json_structure #json.dumps(json_structure, indent=4)
         
             
+    def alignToGrid(self, time_list, records):
+        # convert the UTC timestamps and values of one channel into arrays
+        times = pd.to_datetime([record['time'] for record in records], format="%Y-%m-%dT%H:%M:%SZ", utc=True).tz_convert(time_list.tz)
+        values = np.array([-1 if record['value'] is None else record['value'] for record in records])
+        reported = np.array([record['value'] is not None for record in records], dtype=bool)
+
+        # each record takes the first free slot at or after its own time, slots before it are filled with -1
+        order = np.arange(len(records))
+        slots = time_list.searchsorted(times, side='left')
+        slots = order + np.maximum.accumulate(slots - order)
+        inside = slots < len(time_list)
+
+        grid = np.full(len(time_list), -1, dtype=np.result_type(values.dtype, np.int64))
+        grid[slots[inside]] = values[inside]
+        # slots holding a reported value, -1 elsewhere is padding and not a reading
+        valid = np.zeros(len(time_list), dtype=bool)
+        valid[slots[inside]] = reported[inside]
+
+        return times[inside], slots[inside], grid, valid
+
     def composeDataFrame(self, deviceID, currentDate, measurements):
-        df = pd.DataFrame()
+        return self.composeFrames(deviceID, currentDate, measurements)[0]
+
+    def composeFrames(self, deviceID, currentDate, measurements):
+        # the day frame of one device and a frame telling which of its measurements are readings
         time_list = pd.date_range(start=currentDate.replace(hour=0, minute=0),end=currentDate.replace(hour=23, minute=55), freq="5min", tz='US/Eastern')   
-        index = 0
         if measurements is None:
             #print(currentDate.strftime('%Y-%m-%d'), " data not available")
-            return
+            return None, None
         else:
+            columns = []
+            masks = []
             for component in measurements:
                 if(len(component['values'])>0):
-                    new_df = pd.DataFrame()
-                    current_index = 0
-                   
-                    for record in component['values']:
-                        if(record['value'] is None):
-                            record['value'] = -1   
-                        # Convert UTC time to NY time
-                        ny_time = self.utc2ny(datetime.strptime(record['time'], "%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=pytz.utc))
-                        ny_time_string = ny_time.strftime("%Y-%m-%d %H:%M:%S")
-                         
-                        # Fill the record before sunrise to -1    
-                        if(ny_time > time_list[current_index]):
-                            update_date = time_list[current_index]                     
-                            while(update_date < ny_time):
-                                if(index==0):
-                                    tmp_df = pd.DataFrame({'time': update_date.strftime("%Y-%m-%d %H:%M:%S"),'value':[-1]})
-                                else:
-                                    tmp_df = pd.DataFrame({'value': [-1]})
-                                new_df = pd.concat([new_df, tmp_df], axis=0)
-                                current_index = current_index + 1
-                                update_date = time_list[current_index]
-                        
-                        if(index==0):
-                            tmp_df = pd.DataFrame({'time': ny_time_string,'value':[record['value']]})
-                        else:
-                            tmp_df = pd.DataFrame({'value':[record['value']]})
-                        current_index = current_index + 1
-                
-                        new_df = pd.concat([new_df, tmp_df], axis=0)  
-                
-                  
-                    while(current_index<time_list.shape[0]):
-                        if(index == 0):
-                             tmp_df = pd.DataFrame({'time': time_list[current_index].strftime("%Y-%m-%d %H:%M:%S"),'value':[-1]})
-                        else:
-                            tmp_df = pd.DataFrame({'value':[-1]})
-                        new_df = pd.concat([new_df, tmp_df], axis=0)
-                        current_index = current_index + 1
-                    index = index + 1
-
-                    df = pd.concat([df, new_df], axis=1, ignore_index=True)
-                    
+                    times, slots, grid, valid = self.alignToGrid(time_list, component['values'])
+                    # the first channel carries the time column
+                    if(len(columns)==0):
+                        time_column = np.array(time_list.strftime("%Y-%m-%d %H:%M:%S"), dtype=object)
+                        time_column[slots] = times.strftime("%Y-%m-%d %H:%M:%S")
+                        columns.append(time_column)
+                    columns.append(grid)
+                    masks.append(valid)
                 else:
                     print(deviceID, component)
+
+            df = pd.DataFrame(dict(enumerate(columns)))
             
             if deviceID in self.inverterList: 
-                deviceid = pd.concat([pd.DataFrame([self.inverterList[deviceID]])] * len(df))
-                df = pd.concat([df, deviceid], axis=1, ignore_index=True)
+                df[len(df.columns)] = self.inverterList[deviceID]
                 df.columns = ['time','ac_power','ac_power_l1','ac_power_l2','ac_power_l3', 'ac_reactive_power','ac_reactive_power_l1','ac_reactive_power_l2','ac_reactive_power_l3','ac_apparent_power','ac_apparent_power_l1','ac_apparent_power_l2','ac_apparent_power_l3','ac_voltage_l1','ac_voltage_l2','ac_voltage_l3','ac_current_l1','ac_current_l2','ac_current_l3','grid_frequency','dc_power_a','dc_power_b','dc_voltage_a','dc_voltage_b','dc_current_a','dc_current_b','iso', 'deviceID'] 
                 
             elif deviceID in self.sensorList:
                 if deviceID in self.solarIrradiance:
                     df.columns = ['time','ambient_temp1','ambient_temp2', 'ambient_rh', 'ir']
                 else:
-                    deviceid = pd.concat([pd.DataFrame([self.sensorList[deviceID]])] * len(df))
-                    df = pd.concat([df, deviceid], axis=1, ignore_index=True)
+                    df[len(df.columns)] = self.sensorList[deviceID]
                     df.columns = ['time','inv_temp1', 'inv_temp2', 'inv_rh', 'deviceID']
                     df = df[['inv_temp1', 'inv_temp2','inv_rh','deviceID']]
                     
             else:
                 print("Wrong Device ID")
-                return None
+                return None, None
 
+            valid = pd.DataFrame(dict(zip([column for column in df.columns if column not in ['time', 'deviceID']], masks)), index=df.index)
 
-        return df
+        return df, valid
 
 
-    def loginWebsite(self):
+    def setDaysPerRequest(self, daysPerRequest):
+        self.daysPerRequest = daysPerRequest
 
-        login_payloads = {
-            'grant_type': 'password',
-            'username': self.__username,
-            'password': self.__password,
-            'client_id' : 'SPpbeOS'
-        }
+    def setCoalesceDevices(self, coalesceDevices):
+        self.coalesceDevices = coalesceDevices
+
+    def setMaxWorkers(self, maxWorkers):
+        self.maxWorkers = maxWorkers
+
+    def setBackfillWorkers(self, backfillWorkers):
+        self.backfillWorkers = backfillWorkers
+
+    def setRequestRate(self, requestsPerSecond):
+        self.rateLimiter = rate_limiter.RateLimiter(requestsPerSecond)
 
-        response = requests.post(self.login_url, headers=self.login_header, data=login_payloads)
-        if(response.status_code==200):
+    def setResponseCache(self, cachePath, maxSize=None):
+        self.responseCache = response_cache.ResponseCache(cachePath, maxSize)
+
+    def setReplay(self, replay):
+        self.replay = replay
+
+    def setOutputFormat(self, outputFormat):
+        self.outputFormat = outputFormat
+
+    def openSession(self):
+        # one keep-alive session per run, sized for the number of in-flight requests
+        if(self.session is None):
+            self.session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=2, pool_maxsize=max(self.maxWorkers*self.backfillWorkers, 1))
+            self.session.mount('https://', adapter)
+        return self.session
+
+    def closeSession(self):
+        if(self.session is not None):
+            self.session.close()
+            self.session = None
+
+    def loginWebsite(self):
+
+        # a cached token skips the password grant, an expired one is refreshed
+        self.tokenManager.setSession(self.openSession())
+        access_token = self.tokenManager.getAccessToken()
+        if(access_token is not None):
             print("Login Succeed")
         else:
             print("Login Failed")
             return -1
 
-        self.access_token = json.loads(response.text)['access_token']
-    
-    def requestInfo(self, currentDate):
+        self.access_token = access_token
 
-        begin_time = (self.ny2utc((currentDate-timedelta(days=1)).replace(hour=23, minute=55))).strftime("%Y-%m-%dT%H:%M:%S.000Z")
-        end_time = (self.ny2utc(currentDate.replace(hour=23, minute=55))).strftime("%Y-%m-%dT%H:%M:%S.000Z")
-        #end_time = (self.ny2utc(currentDate+timedelta(days=1))).strftime("%Y-%m-%dT%H:%M:%S.000Z")
-        #begin_time = currentDate.strftime("%Y-%m-%dT00:00:00.000Z")
-        #end_time = (currentDate+timedelta(days=1)).strftime("%Y-%m-%dT00:00:00.000Z")
+    def getAccessToken(self):
+        # refresh proactively once the first login succeeded
+        if(self.tokenManager.token is not None):
+            access_token = self.tokenManager.getAccessToken()
+            if(access_token is not None):
+                self.access_token = access_token
+        return self.access_token
 
-        info_header = {
+    def composeInfoHeader(self):
+        return {
             'Accept' : 'application/json, text/plain, */*',
             'Accept-Encoding' : 'gzip, deflate, br',
             'Accept-Language' : 'en-US,en;q=0.9,zh-CN;q=0.8,zh;q=0.7',
             'Connection' : 'keep-alive',
             'Content-Type' : 'application/json',
-            'Authorization' : 'Bearer '+ self.access_token,
+            'Authorization' : 'Bearer '+ self.getAccessToken(),
             'Host' : 'uiapi.sunnyportal.com',
             'Origin' : 'https://ennexos.sunnyportal.com',
             'Referer' : 'https://ennexos.sunnyportal.com/',
@@ -258,115 +324,398 @@ class SunnyPortal:
             'User-Agent' : 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
             'sec-ch-ua-platform' : 'Windows'
         }
-        
-        
-        inverter_dfs = []
-        sensor_dfs = []
-        
-        solar_info_payloads = self.composePayloads(self.solarIrradiance[0], begin_time, end_time)
+
+    def postMeasurements(self, info_payloads):
+        if(self.responseCache is not None):
+            measurements = self.responseCache.get('sp', self.info_url, info_payloads, info_payloads['dateTimeBegin'], info_payloads['dateTimeEnd'])
+            if(measurements is not None or self.replay):
+                return measurements
         try:
-            solar_measurements = json.loads(requests.post(self.info_url, headers=info_header, json=solar_info_payloads).text)
-            solar_df = self.composeDataFrame(self.solarIrradiance[0], currentDate, solar_measurements)
+            for attempt in range(2):
+                if(self.rateLimiter is not None):
+                    self.rateLimiter.acquire()
+                response = self.openSession().post(self.info_url, headers=self.composeInfoHeader(), json=info_payloads)
+                # the token was rejected before its expiry, refresh it and retry once
+                if(response.status_code != 401):
+                    break
+                self.tokenManager.invalidate()
+            measurements = json.loads(response.text)
         except Exception as e:
-            solar_measurements = None
-        
+            return None
+
+        # only complete answers are cached, error bodies are not lists
+        if(self.responseCache is not None and response.status_code == 200 and isinstance(measurements, list)):
+            self.responseCache.put('sp', self.info_url, info_payloads, info_payloads['dateTimeBegin'], info_payloads['dateTimeEnd'], measurements)
+        return measurements
+
+    def fetchMeasurements(self, payload_list):
+        # results come back in the same order as payload_list
+        if(self.maxWorkers <= 1):
+            return [self.postMeasurements(payloads) for payloads in payload_list]
+
+        self.openSession()
+        with ThreadPoolExecutor(max_workers=self.maxWorkers) as executor:
+            return list(executor.map(self.postMeasurements, payload_list))
+    
+    def composeWindow(self, currentDate):
+        begin_time = (self.ny2utc((currentDate-timedelta(days=1)).replace(hour=23, minute=55))).strftime("%Y-%m-%dT%H:%M:%S.000Z")
+        end_time = (self.ny2utc(currentDate.replace(hour=23, minute=55))).strftime("%Y-%m-%dT%H:%M:%S.000Z")
+        #end_time = (self.ny2utc(currentDate+timedelta(days=1))).strftime("%Y-%m-%dT%H:%M:%S.000Z")
+        #begin_time = currentDate.strftime("%Y-%m-%dT00:00:00.000Z")
+        #end_time = (currentDate+timedelta(days=1)).strftime("%Y-%m-%dT00:00:00.000Z")
+        return begin_time, end_time
+
+    def listDevices(self):
+        # irradiance first, then inverter and sensor of each device in turn
+        deviceIDs = [self.solarIrradiance[0]]
         for inverter, sensor in zip(self.inverterList, self.sensorList):
+            deviceIDs = deviceIDs + [inverter, sensor]
+        return deviceIDs
+
+    def composeCoalescedPayloads(self, begin_time, end_time):
+        # pack whole devices into as few requests as maxQueryItems allows
+        payload_list = []
+        for deviceID in self.listDevices():
+            queryItems = self.composePayloads(deviceID, begin_time, end_time)['queryItems']
+            if(len(payload_list)==0 or len(payload_list[-1]['queryItems'])+len(queryItems) > self.maxQueryItems):
+                payload_list.append({'queryItems': [],
+                   'dateTimeBegin': begin_time,
+                   'dateTimeEnd': end_time})
+            payload_list[-1]['queryItems'] += queryItems
+        return payload_list
+
+    def demultiplexMeasurements(self, payload_list, responses):
+        # regroup the channels of coalesced responses by componentId, in listDevices order
+        measurements = {deviceID: [] for deviceID in self.listDevices()}
+        for payloads, response in zip(payload_list, responses):
+            if(not isinstance(response, list)):
+                # a failed request fails every device it carried
+                for item in payloads['queryItems']:
+                    measurements[item['componentId']] = response
+                continue
+            for item, component in zip(payloads['queryItems'], response):
+                deviceID = component.get('componentId', item['componentId'])
+                if(isinstance(measurements[deviceID], list)):
+                    measurements[deviceID].append(component)
+        return [measurements[deviceID] for deviceID in self.listDevices()]
+
+    def requestMeasurements(self, begin_time, end_time):
+        if(self.coalesceDevices):
+            payload_list = self.composeCoalescedPayloads(begin_time, end_time)
+            return self.demultiplexMeasurements(payload_list, self.fetchMeasurements(payload_list))
+        return self.fetchMeasurements([self.composePayloads(deviceID, begin_time, end_time) for deviceID in self.listDevices()])
+
+    def saveDay(self, currentDate, measurements):
         
-            inverter_info_payloads = self.composePayloads(inverter, begin_time, end_time)
-            sensor_info_payloads = self.composePayloads(sensor, begin_time, end_time)
-            
-            try:
-                inverter_measurements = json.loads(requests.post(self.info_url, headers=info_header, json=inverter_info_payloads).text)
-            except Exception as e:
-                inverter_measurements = None
-           
-            try:
-                sensor_measurements = json.loads(requests.post(self.info_url, headers=info_header, json=sensor_info_payloads).text)
-            except Exception as e:
-                sensor_measurements = None
+        inverter_dfs = []
+        sensor_dfs = []
+        # validity of every measurement, so the typed copy keeps real -1 readings
+        inverter_valids = []
+        sensor_valids = []
+
+        if(measurements[0] is None):
+            raise Exception("solar irradiance request failed")
+        # a partly evicted cache must not overwrite a complete day with fewer devices
+        if(self.replay and any(measurement is None for measurement in measurements)):
+            raise Exception("not completely cached, day skipped")
+        solar_df, solar_valid = self.composeFrames(self.solarIrradiance[0], currentDate, measurements[0])
+        
+        for i, (inverter, sensor) in enumerate(zip(self.inverterList, self.sensorList)):
                 
-            inverter_df = self.composeDataFrame(inverter, currentDate, inverter_measurements)
+            inverter_df, inverter_valid = self.composeFrames(inverter, currentDate, measurements[2*i+1])
             inverter_dfs.append(inverter_df)
+            inverter_valids.append(inverter_valid)
             
-            sensor_df = self.composeDataFrame(sensor, currentDate, sensor_measurements)     
+            sensor_df, sensor_valid = self.composeFrames(sensor, currentDate, measurements[2*i+2])     
             sensor_df = pd.concat([solar_df, sensor_df], axis=1)
+            sensor_valids.append(pd.concat([solar_valid, sensor_valid], axis=1))
         
             sensor_dfs.append(sensor_df)
             
         op_filename = "operating/sp_" + currentDate.strftime("%Y-%m-%d")
         env_filename = "environmental/sp_" + currentDate.strftime("%Y-%m-%d")
         
+        saved = 0
         try:
             final_inverter_df = pd.concat(inverter_dfs)
-            final_inverter_df.to_csv(self.path + op_filename +".csv", index=False)
+            self.saveFrame(final_inverter_df, self.path + op_filename, pd.concat(inverter_valids))
             print(op_filename," has been saved!")
+            saved = saved + 1
         except Exception as e:
                 print(op_filename,"save Failed: ",e)
     
         try:
             final_sensor_df = pd.concat(sensor_dfs)
-            final_sensor_df.to_csv(self.path + env_filename +".csv", index=False)
+            self.saveFrame(final_sensor_df, self.path + env_filename, pd.concat(sensor_valids))
             print(env_filename," has been saved!")
+            saved = saved + 1
         except Exception as e:
                 print(env_filename,"save Failed: ",e)
-        
 
-    def SunnyPortal(self):
+        if(saved == 2):
+            self.recordProgress("sp_" + currentDate.strftime("%Y-%m-%d"), "done")
+
+    def typeFrame(self, df, valid=None):
+        # float32 measurements with missing values, a real timestamp and a categorical deviceID
+        # valid (from composeFrames) tells readings from padding; without it every -1 is taken as missing,
+        # which also drops real -1 readings (e.g. ac_reactive_power_l1, ambient_temp2)
+        typed = pd.DataFrame(index=range(len(df)))
+        for column in df.columns:
+            if(column == 'time'):
+                typed[column] = pd.to_datetime(df[column], format="%Y-%m-%d %H:%M:%S").values
+            elif(column == 'deviceID'):
+                typed[column] = pd.Categorical(df[column].astype(str), categories=sorted(set(self.inverterList.values())))
+            else:
+                values = pd.to_numeric(df[column], errors='coerce').astype(np.float32)
+                if(valid is not None and column in valid.columns):
+                    typed[column] = values.where(valid[column].to_numpy()).values
+                else:
+                    typed[column] = values.mask(values == -1).values
+        return typed
+
+    def untypeFrame(self, typed):
+        # the csv layout: time strings, -1 for missing values and an integer deviceID
+        df = pd.DataFrame(index=typed.index)
+        for column in typed.columns:
+            if(column == 'time'):
+                df[column] = typed[column].dt.strftime("%Y-%m-%d %H:%M:%S")
+            elif(column == 'deviceID'):
+                df[column] = typed[column].astype(np.int64)
+            else:
+                df[column] = typed[column].astype(np.float64).fillna(-1)
+        return df
 
-        try:
-            self.loginWebsite()
-            print("Crediential verified")
-        except Exception as e:
-            print("Login Error: ", e)
+    def saveFrame(self, df, filename, valid=None):
+        if(self.outputFormat in ['csv', 'both']):
+            df.to_csv(filename +".csv", index=False)
+        if(self.outputFormat in ['parquet', 'both']):
+            self.typeFrame(df, valid).to_parquet(filename +".parquet", index=False)
+
+    def frameExists(self, filename):
+        # readFrame reads either format, a day is never downloaded again only because of the output format
+        return os.path.isfile(filename +".csv") or os.path.isfile(filename +".parquet")
+
+    def readFrame(self, filename, typed=False, columns=None):
+        # parquet is preferred when both formats exist, either one reads back to the same layout
+        if(os.path.isfile(filename +".parquet")):
+            df = pd.read_parquet(filename +".parquet", columns=columns)
+            return df if typed else self.untypeFrame(df)
+        df = pd.read_csv(filename +".csv", usecols=columns)
+        return self.typeFrame(df) if typed else df
+
+    def readOperating(self, currentDate, typed=False, columns=None):
+        return self.readFrame(self.path + "operating/sp_" + currentDate.strftime("%Y-%m-%d"), typed, columns)
+
+    def readEnvironmental(self, currentDate, typed=False, columns=None):
+        return self.readFrame(self.path + "environmental/sp_" + currentDate.strftime("%Y-%m-%d"), typed, columns)
+
+    def convertFiles(self):
+        # write the typed parquet copy of every csv day that does not have one yet
+        # lossy: the csv stores padding as -1 too, so real -1 readings become missing values
+        for folder in ["operating/", "environmental/"]:
+            for file in sorted(os.listdir(self.path + folder)):
+                filename = self.path + folder + file[:-4]
+                if(file.endswith(".csv") and not os.path.isfile(filename +".parquet")):
+                    self.typeFrame(pd.read_csv(filename +".csv")).to_parquet(filename +".parquet", index=False)
+                    print(folder + file[:-4], " converted!")
 
+    def requestInfo(self, currentDate):
 
-        if(self.startDate is None):
-            self.startDate = datetime.now() - timedelta(days=1)
-        
-        currentDate = self.startDate
+        begin_time, end_time = self.composeWindow(currentDate)
+        measurements = self.requestMeasurements(begin_time, end_time)
+        self.saveDay(currentDate, measurements)
+
+    def isComplete(self, measurements, lastDate):
+        # a truncated window either fails or stops before the last requested day
+        last_begin = self.composeWindow(lastDate)[0].replace(".000Z", "Z")
+        for response in measurements:
+            if(not isinstance(response, list)):
+                return False
+            for component in response:
+                if(len(component['values'])>0 and component['values'][-1]['time'] <= last_begin):
+                    return False
+        return True
+
+    def splitMeasurements(self, measurements, days):
+        # cut every channel of a multi-day response into the single-day windows used by requestInfo
+        bounds = [tuple(t.replace(".000Z", "Z") for t in self.composeWindow(currentDate)) for currentDate in days]
+        day_measurements = [[] for currentDate in days]
+        for response in measurements:
+            day_responses = [[] for currentDate in days]
+            for component in response:
+                times = [record['time'] for record in component['values']]
+                for i, (begin_time, end_time) in enumerate(bounds):
+                    values = component['values'][bisect.bisect_right(times, begin_time):bisect.bisect_right(times, end_time)]
+                    day_responses[i].append(dict(component, values=values))
+            for i in range(len(days)):
+                day_measurements[i].append(day_responses[i])
+        return day_measurements
+
+    def cacheDay(self, currentDate, measurements):
+        # store the slice of a multi-day answer under the single-day requests, which replay falls back to
+        if(self.responseCache is None or any(not isinstance(measurement, list) for measurement in measurements)):
+            return
+        begin_time, end_time = self.composeWindow(currentDate)
+        components = {deviceID: iter(measurement) for deviceID, measurement in zip(self.listDevices(), measurements)}
+        if(self.coalesceDevices):
+            payload_list = self.composeCoalescedPayloads(begin_time, end_time)
+        else:
+            payload_list = [self.composePayloads(deviceID, begin_time, end_time) for deviceID in self.listDevices()]
+        for payloads in payload_list:
+            try:
+                response = [next(components[item['componentId']]) for item in payloads['queryItems']]
+            except StopIteration:
+                continue
+            self.responseCache.put('sp', self.info_url, payloads, begin_time, end_time, response)
 
-        if(self.endDate is None):
-            self.endDate = datetime.now() - timedelta(days=1)
+    def requestRange(self, days):
 
+        # a replay that misses the cache must not mark intact days as unfinished
+        if(not self.replay):
+            for currentDate in days:
+                self.recordProgress("sp_" + currentDate.strftime("%Y-%m-%d"), "started")
+
+        if(len(days)==1):
+            try:
+                self.requestInfo(days[0])
+            except Exception as e:
+                print(days[0].strftime("%Y-%m-%d"), " Request Information Error: ",e)
+                if(not self.replay):
+                    self.recordException("sp_" + days[0].strftime("%Y-%m-%d"))
+            return
+
+        begin_time = self.composeWindow(days[0])[0]
+        end_time = self.composeWindow(days[-1])[1]
+        measurements = self.requestMeasurements(begin_time, end_time)
+
+        # fall back to smaller windows when the API truncates the response
+        if(not self.isComplete(measurements, days[-1])):
+            print(days[0].strftime("%Y-%m-%d"), "to", days[-1].strftime("%Y-%m-%d"), " truncated, retry with smaller windows")
+            half = len(days)//2
+            self.requestRange(days[:half])
+            self.requestRange(days[half:])
+            return
+
+        for currentDate, day_measurements in zip(days, self.splitMeasurements(measurements, days)):
+            if(not self.replay):
+                self.cacheDay(currentDate, day_measurements)
+            try:
+                self.saveDay(currentDate, day_measurements)
+            except Exception as e:
+                print(currentDate.strftime("%Y-%m-%d"), " Request Information Error: ",e)
+                if(not self.replay):
+                    self.recordException("sp_" + currentDate.strftime("%Y-%m-%d"))
+
+    def recordException(self, filename):
+        with self.lock:
+            flag = 0
+            # Open the file in append mode
+            with open('exception/sp.txt', 'r') as f:
+                for line in f:
+                # Check if the string exists in the line
+                    if filename in line.strip():
+                        # Write the new line
+                        flag = 1
+                       
+             
+            if(flag == 0):
+                with open('exception/sp.txt', 'a') as f:
+                    f.write(filename + "\n")
+
+    def loadProgress(self):
+        # days started by an earlier run but never saved have to be fetched again
+        self.unfinished = set()
+        if(os.path.isfile(self.path + self.progressFile)):
+            with open(self.path + self.progressFile, 'r') as f:
+                for line in f:
+                    fields = line.split()
+                    if(len(fields)==2 and fields[1]=="started"):
+                        self.unfinished.add(fields[0])
+                    elif(len(fields)==2):
+                        self.unfinished.discard(fields[0])
+
+    def recordProgress(self, filename, status):
+        with self.lock:
+            with open(self.path + self.progressFile, 'a') as f:
+                f.write(filename + " " + status + "\n")
+            if(status == "started"):
+                self.unfinished.add(filename)
+            else:
+                self.unfinished.discard(filename)
+
+    def compactProgress(self):
+        # only days that are still unfinished need to stay in the log
+        with self.lock:
+            if(len(self.unfinished)==0):
+                if(os.path.isfile(self.path + self.progressFile)):
+                    os.remove(self.path + self.progressFile)
+            else:
+                with open(self.path + self.progressFile, 'w') as f:
+                    for filename in sorted(self.unfinished):
+                        f.write(filename + " started\n")
+
+    def isSaved(self, currentDate):
+        filename= "sp_" + currentDate.strftime("%Y-%m-%d")
+        return self.frameExists(self.path+"operating/"+filename) and self.frameExists(self.path+"environmental/"+filename) and filename not in self.unfinished
+
+    def listWindows(self):
+        # consecutive missing days are grouped into windows of up to daysPerRequest days
+        windows = []
+        window = []
+        currentDate = self.startDate
         while (currentDate <= self.endDate):
-            filename= "sp_" + currentDate.strftime("%Y-%m-%d")
-            if(os.path.isfile(self.path+"operating/"+filename+".csv") and os.path.isfile(self.path+"environmental/"+filename+".csv") ):
-                print(filename, " existed!")
+            # replay rewrites every day of the range from the cache
+            if(not self.replay and self.isSaved(currentDate)):
+                print("sp_" + currentDate.strftime("%Y-%m-%d"), " existed!")
+                if(len(window)>0):
+                    windows.append(window)
+                    window = []
             else:
-                try:
-                    self.requestInfo(currentDate)
-                except Exception as e:
-                    print(currentDate.strftime("%Y-%m-%d"), " Request Information Error: ",e)
-                    flag = 0
-                    # Open the file in append mode
-                    with open('exception/sp.txt', 'r') as f:
-                        for line in f:
-                        # Check if the string exists in the line
-                            if filename in line.strip():
-                                # Write the new line
-                                flag = 1
-                               
-                     
-                    if(flag == 0):
-                        with open('exception/sp.txt', 'a') as f:
-                            f.write(filename + "\n")
-                    
-                    currentDate = currentDate + timedelta(days=1)
-                    continue
-                
+                window.append(currentDate)
+                if(len(window)>=self.daysPerRequest):
+                    windows.append(window)
+                    window = []
 
             currentDate = currentDate + timedelta(days=1)
 
-        
-
-
+        if(len(window)>0):
+            windows.append(window)
+        return windows
 
+    def backfill(self, windows):
+        # windows are handed out to a pool of workers, one slow day no longer blocks the rest
+        if(self.backfillWorkers <= 1):
+            for window in windows:
+                self.requestRange(window)
+            return
 
+        self.openSession()
+        with ThreadPoolExecutor(max_workers=self.backfillWorkers) as executor:
+            for result in executor.map(self.requestRange, windows):
+                pass
 
+    def SunnyPortal(self):
 
+        if(not self.replay):
+            try:
+                self.loginWebsite()
+                print("Crediential verified")
+            except Exception as e:
+                print("Login Error: ", e)
 
 
+        if(self.startDate is None):
+            self.startDate = datetime.now() - timedelta(days=1)
 
+        if(self.endDate is None):
+            self.endDate = datetime.now() - timedelta(days=1)
 
+        # days saved as csv before the parquet output was switched on are converted, not fetched again
+        if(self.outputFormat in ['parquet', 'both'] and not self.replay):
+            self.convertFiles()
 
+        self.loadProgress()
+        self.backfill(self.listWindows())
+        self.compactProgress()
 
+        self.closeSession()
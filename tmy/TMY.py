@@ -0,0 +1,113 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+
+
+class TMY:
+
+    # NSRDB yearly files (tmy_<year>.csv) parsed once into a numpy cache, reparsed when a file changes
+    timeColumns = ['Year', 'Month', 'Day', 'Hour', 'Minute']
+    valueColumns = ['GHI', 'Temperature', 'Relative Humidity']
+    # NSRDB rows are stamped in local standard time
+    offset = -5
+
+    def __init__(self, path, cacheFile=None):
+        self.path = path
+        self.cacheFile = cacheFile or os.path.join(path, "tmy_cache.npz")
+        self.times = None
+        self.values = None
+        self.minimum = None
+        self.maximum = None
+
+    def listFiles(self):
+        return sorted(file for file in os.listdir(self.path) if file.startswith("tmy_") and file.endswith(".csv"))
+
+    def composeSignature(self):
+        # the cache is only valid for the same files with the same size and modification time
+        signature = []
+        for file in self.listFiles():
+            stat = os.stat(os.path.join(self.path, file))
+            signature.append([file, stat.st_size, stat.st_mtime_ns])
+        return json.dumps(signature)
+
+    def parseFiles(self):
+        times = []
+        values = []
+        for file in self.listFiles():
+            try:
+                df = pd.read_csv(os.path.join(self.path, file), skiprows=2, usecols=self.timeColumns + self.valueColumns)
+                times.append(df[self.timeColumns].to_numpy(dtype=np.int16))
+                values.append(df[self.valueColumns].to_numpy(dtype=np.float64))
+            except Exception as e:
+                print(file, "data missed: ", e)
+        self.times = np.concatenate(times)
+        values = np.concatenate(values)
+        # bounds keep the exact file values, the cached rows are stored compact
+        self.computeBounds(values)
+        self.values = values.astype(np.float32)
+
+    def computeBounds(self, values):
+        # minimum and maximum of every column per month (0-11) and hour of day (0-23)
+        slot = (self.times[:, 1].astype(np.int64) - 1) * 24 + self.times[:, 3]
+        self.minimum = np.full((len(self.valueColumns), 12*24), np.nan)
+        self.maximum = np.full((len(self.valueColumns), 12*24), np.nan)
+        for i in range(len(self.valueColumns)):
+            np.fmin.at(self.minimum[i], slot, values[:, i])
+            np.fmax.at(self.maximum[i], slot, values[:, i])
+        self.minimum = self.minimum.reshape(len(self.valueColumns), 12, 24)
+        self.maximum = self.maximum.reshape(len(self.valueColumns), 12, 24)
+
+    def loadCache(self, signature):
+        if(not os.path.isfile(self.cacheFile)):
+            return False
+        try:
+            with np.load(self.cacheFile) as cache:
+                if(str(cache['signature']) != signature or list(cache['columns']) != self.valueColumns):
+                    return False
+                self.times = cache['times']
+                self.values = cache['values']
+                self.minimum = cache['minimum']
+                self.maximum = cache['maximum']
+            return True
+        except Exception as e:
+            print("TMY cache unreadable: ", e)
+            return False
+
+    def saveCache(self, signature):
+        tmp_file = self.cacheFile + "." + str(os.getpid()) + ".tmp.npz"
+        np.savez(tmp_file, signature=signature, columns=np.array(self.valueColumns), times=self.times, values=self.values, minimum=self.minimum, maximum=self.maximum)
+        os.replace(tmp_file, self.cacheFile)
+
+    def load(self):
+        signature = self.composeSignature()
+        if(not self.loadCache(signature)):
+            self.parseFiles()
+            self.saveCache(signature)
+            print(len(self.listFiles()), "TMY files parsed")
+        return self
+
+    def getFrame(self):
+        df = pd.DataFrame(self.times, columns=self.timeColumns)
+        for i, column in enumerate(self.valueColumns):
+            df[column] = self.values[:, i]
+        return df
+
+    def getBounds(self, column):
+        # (minimum, maximum) arrays of shape (12, 24) indexed by [month-1, hour]
+        i = self.valueColumns.index(column)
+        return self.minimum[i], self.maximum[i]
+
+    def getGlobalBounds(self, column):
+        minimum, maximum = self.getBounds(column)
+        return float(np.nanmin(minimum)), float(np.nanmax(maximum))
+
+    def lookupBounds(self, column, times):
+        # bounds for every timestamp, tz-aware times are first moved to the standard time of the TMY rows
+        times = pd.DatetimeIndex(times)
+        if(times.tz is not None):
+            times = times.tz_convert('Etc/GMT%+d' % -self.offset)
+        minimum, maximum = self.getBounds(column)
+        month = np.asarray(times.month) - 1
+        hour = np.asarray(times.hour)
+        return minimum[month, hour], maximum[month, hour]
@@ -2,12 +2,76 @@ from bs4 import BeautifulSoup
 import requests
 import json
 from datetime import datetime, timedelta
+import numpy as np
 import pandas as pd
 import os
+import sys
 import pytz
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
-severe_weather = ['Haze', 'Thunder', 'Storm', 'Heavy', 'Drizzle', 'T-storm'] # 10 points
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from http_lib import ResponseCache as response_cache
+from http_lib import RateLimiter as rate_limiter
+
+# Weather condition classification, shared by the notebook and manage_ws.py
+severe_weather = ['Haze', 'Thunder', 'Storm', 'Heavy', 'Drizzle', 'T-Storm'] # 10 points
 mild_weather = ['Cloudy', 'Rain', 'Fog', 'Smoke', 'Mist'] # 5 point
+severe_points = 10
+mild_points = 5
+
+# phrase dictionary: every phrase seen gets a stable code, its score is computed once
+weather_phrases = []
+weather_scores = []
+weather_codes = dict()
+
+def scorePhrase(phrase):
+    # "Heavy T-Storm / Windy" is scored word by word
+    points = 0
+    for k in str(phrase).split("/"):
+        for kk in k.split():
+            if(kk in severe_weather):
+                points = points + severe_points
+            elif(kk in mild_weather):
+                points = points + mild_points
+    return points
+
+def addPhrases(phrases):
+    for phrase in phrases:
+        if(phrase not in weather_codes):
+            weather_codes[phrase] = len(weather_phrases)
+            weather_phrases.append(phrase)
+            weather_scores.append(scorePhrase(phrase))
+
+def encodeConditions(conditions):
+    # categories follow the phrase dictionary so the codes are the same in every run
+    conditions = pd.Series(conditions)
+    addPhrases(conditions.dropna().unique())
+    return pd.Categorical(conditions, categories=weather_phrases)
+
+def scoreConditions(conditions):
+    codes = encodeConditions(conditions).codes
+    # missing conditions have code -1 and pick the trailing 0
+    table = np.append(np.array(weather_scores, dtype=np.int64), 0)
+    return table[codes]
+
+def savePhraseDictionary(filename):
+    content = {'severe_weather': severe_weather, 'mild_weather': mild_weather, 'phrases': weather_phrases, 'scores': weather_scores}
+    with open(filename, 'w') as f:
+        json.dump(content, f, indent=1)
+
+def loadPhraseDictionary(filename):
+    if(not os.path.isfile(filename)):
+        return
+    with open(filename, 'r') as f:
+        content = json.load(f)
+    # stored scores are only reused when they were computed from the same classification
+    same_lists = content['severe_weather'] == severe_weather and content['mild_weather'] == mild_weather
+    for phrase, score in zip(content['phrases'], content['scores']):
+        if(phrase not in weather_codes):
+            weather_codes[phrase] = len(weather_phrases)
+            weather_phrases.append(phrase)
+            weather_scores.append(score if same_lists else scorePhrase(phrase))
 
 class WeatherStation:
 
@@ -15,6 +79,22 @@ class WeatherStation:
     endDate = None
     apiKey =  None
     path = None
+    observation_url = "https://api.weather.com/v1/location/KCAE:9:US/observations/historical.json"
+    # local time of the station, the daily files keep naive local timestamps
+    timezone = 'America/New_York'
+
+    # raw responses cache, replay rebuilds the daily files from it without calling the API
+    responseCache = None
+    replay = False
+
+    # consecutive missing days are requested together, the historical endpoint serves up to 31 days at once
+    daysPerRequest = 31
+    maxDaysPerRequest = 31
+    # windows are requested concurrently over one keep-alive session
+    maxWorkers = 4
+    session = None
+    rateLimiter = None
+    lock = threading.Lock()
     
     def __init__(self, path, apiKey):
         self.path = path
@@ -26,6 +106,12 @@ class WeatherStation:
     def setEndDate(self, endDate):
         self.endDate = endDate
         
+    def setResponseCache(self, cachePath, maxSize=None):
+        self.responseCache = response_cache.ResponseCache(cachePath, maxSize)
+
+    def setReplay(self, replay):
+        self.replay = replay
+
     def getAPIKey(self):
         return self.apiKey
 
@@ -35,34 +121,96 @@ class WeatherStation:
     def getEndDate(self):
         return self.endDate
     
-    def requestInfo(self, currentDate):
-        
-        current_string = currentDate.strftime('%Y%m%d')
-        url = "https://api.weather.com/v1/location/KCAE:9:US/observations/historical.json?apiKey="+self.apiKey+"&units=m&startDate="+current_string
-        response = requests.get(url)
-        if(response.status_code==200):
-            print(current_string,"Request Succeed!")
-        else:
-            print(current_string,"Request Failed!")
-   
-        # load data
-        data_df = pd.DataFrame(columns=['time', 'ambient_temperature', 'relative_humidity', 'weather_condition'])
+    def setTimezone(self, timezone):
+        self.timezone = timezone
+
+    def composeDataFrame(self, observations):
+        # pull the used fields of every observation in one pass instead of growing the frame row by row
+        records = pd.DataFrame.from_records(observations, columns=['valid_time_gmt', 'temp', 'rh', 'wx_phrase'])
+        time_list = pd.to_datetime(records['valid_time_gmt'].astype(np.int64), unit='s', utc=True)
+        # integer readings stay integers when some of them are missing
+        values = records[['temp', 'rh']].convert_dtypes()
+        return pd.DataFrame({
+            'time': time_list.dt.tz_convert(self.timezone).dt.tz_localize(None),
+            'ambient_temperature': values['temp'],
+            'relative_humidity': values['rh'],
+            'weather_condition': records['wx_phrase']
+        })
+
+    def setDaysPerRequest(self, daysPerRequest):
+        self.daysPerRequest = max(1, min(daysPerRequest, self.maxDaysPerRequest))
+
+    def setMaxWorkers(self, maxWorkers):
+        self.maxWorkers = maxWorkers
+
+    def setRequestRate(self, requestsPerSecond):
+        self.rateLimiter = rate_limiter.RateLimiter(requestsPerSecond)
+
+    def openSession(self):
+        if(self.session is None):
+            self.session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_maxsize=max(self.maxWorkers, 1))
+            self.session.mount('https://', adapter)
+        return self.session
+
+    def closeSession(self):
+        if(self.session is not None):
+            self.session.close()
+            self.session = None
+
+    def composeParams(self, days):
+        # the api key is left out of the cache key so a new key still hits old responses
+        params = {'units': 'm', 'startDate': days[0].strftime('%Y%m%d')}
+        # single days keep the original request so responses cached before range mode are still found
+        if(len(days)>1):
+            params['endDate'] = days[-1].strftime('%Y%m%d')
+        return params
+
+    def requestObservations(self, days):
+        params = self.composeParams(days)
+        begin = days[0].strftime('%Y%m%d')
+        end = days[-1].strftime('%Y%m%d')
+        window = begin if len(days)==1 else begin + "-" + end
+
+        if(self.responseCache is not None):
+            data = self.responseCache.get('ws', self.observation_url, params, begin, end)
+            if(data is not None):
+                return data
+        if(self.replay):
+            print(window,"not cached!")
+            return None
+
+        if(self.rateLimiter is not None):
+            self.rateLimiter.acquire()
+        response = self.openSession().get(self.observation_url, params=dict(params, apiKey=self.apiKey))
+        if(response.status_code!=200):
+            print(window,"Request Failed!")
+            return None
+        print(window,"Request Succeed!")
         data = json.loads(response.text)
-        for v in data['observations']:
-            # Create a datetime object from the Unix epoch time
-            #gmt_time = datetime.fromtimestamp(v['expire_time_gmt'], pytz.timezone('GMT'))
-            # Convert GMT to New York time
-            #ny_time = gmt_time.astimezone(pytz.timezone('America/New_York'))
-            
-            new_row = pd.DataFrame({'time': [datetime.fromtimestamp(v['valid_time_gmt'])], 'ambient_temperature': [v['temp']], 'relative_humidity':[v['rh']], 'weather_condition':[v['wx_phrase']]})
-            data_df = pd.concat([data_df, new_row], ignore_index=True)
-        
+        if(self.responseCache is not None):
+            self.responseCache.put('ws', self.observation_url, params, begin, end, data)
+        return data
+
+    def cacheDay(self, currentDate, data, mask):
+        # the slice of a range answer is stored under the single-day request too, which replay falls back to
+        if(self.responseCache is None or self.replay):
+            return
+        day = currentDate.strftime('%Y%m%d')
+        observations = [observation for observation, selected in zip(data['observations'], mask) if selected]
+        self.responseCache.put('ws', self.observation_url, self.composeParams([currentDate]), day, day, dict(data, observations=observations))
+
+    def saveDay(self, currentDate, data_df):
         filename = "ws_"+currentDate.strftime('%Y-%m-%d')
         try:
             data_df.to_csv(self.path+filename+".csv",index=False)         
             print(filename,"has been saved!")
         except Exception as e:
-            # Open the file in append mode
+            self.recordException(filename)
+            print(filename," save Failed: ",e)
+
+    def recordException(self, filename):
+        with self.lock:
             flag = 0
             # Open the file in append mode
             with open('exception/sp.txt', 'r') as f:
@@ -76,26 +224,91 @@ class WeatherStation:
             if(flag == 0):
                 with open('exception/sp.txt', 'a') as f:
                     f.write(filename + "\n")
-            print(filename," save Failed: ",e)
+
+    def requestInfo(self, currentDate):
+        self.requestRange([currentDate])
+
+    def readDay(self, currentDate, columns=None):
+        dtype = {'ambient_temperature': np.float32, 'relative_humidity': np.float32, 'weather_condition': str}
+        df = pd.read_csv(self.path + "ws_" + currentDate.strftime('%Y-%m-%d') + ".csv", usecols=columns, dtype=dtype)
+        if('time' in df.columns):
+            df['time'] = pd.to_datetime(df['time'], format="%Y-%m-%d %H:%M:%S")
+        return df
+
+    def requestRange(self, days):
+        try:
+            data = self.requestObservations(days)
+            if(data is None and len(days)==1):
+                return
+            missing = days
+            if(data is not None):
+                data_df = self.composeDataFrame(data['observations'])
+                day_list = data_df['time'].dt.strftime('%Y-%m-%d').values
+                missing = []
+                for currentDate in days:
+                    mask = day_list == currentDate.strftime('%Y-%m-%d')
+                    day_df = data_df[mask]
+                    # a day without observations in a range answer is asked for on its own before it is saved empty
+                    if(len(day_df)==0 and len(days)>1):
+                        missing.append(currentDate)
+                    else:
+                        if(len(days)>1):
+                            self.cacheDay(currentDate, data, mask)
+                        self.saveDay(currentDate, day_df)
+        except Exception as e:
+            print("Error: ",e)
+            if(len(days)==1):
+                return
+            missing = days
+
+        if(len(missing)>0 and len(days)>1):
+            print(days[0].strftime('%Y-%m-%d'), "to", days[-1].strftime('%Y-%m-%d'), len(missing), "days missing, retry day by day")
+            for currentDate in missing:
+                self.requestRange([currentDate])
+
+    def listWindows(self):
+        # consecutive missing days are grouped into windows of up to daysPerRequest days
+        windows = []
+        window = []
+        currentDate = self.startDate
+        while (currentDate <= self.endDate):
+            filename= "ws_" + currentDate.strftime("%Y-%m-%d")
+            # replay rewrites every day of the range from the cache
+            if(not self.replay and os.path.isfile(self.path+filename+".csv")):
+                print(filename, " existed!")
+                if(len(window)>0):
+                    windows.append(window)
+                    window = []
+            else:
+                window.append(currentDate)
+                if(len(window)>=self.daysPerRequest):
+                    windows.append(window)
+                    window = []
+
+            currentDate = currentDate + timedelta(days=1)
+
+        if(len(window)>0):
+            windows.append(window)
+        return windows
+
+    def backfill(self, windows):
+        if(self.maxWorkers <= 1):
+            for window in windows:
+                self.requestRange(window)
+            return
+
+        self.openSession()
+        with ThreadPoolExecutor(max_workers=self.maxWorkers) as executor:
+            for result in executor.map(self.requestRange, windows):
+                pass
 
     def WeatherStation(self):
         
         if(self.startDate is None):
             self.startDate = datetime.now() - timedelta(days=1)
         
-        currentDate = self.startDate
-
         if(self.endDate is None):
             self.endDate = datetime.now() - timedelta(days=1)
 
-        while (currentDate <= self.endDate):
-            filename= "ws_" + currentDate.strftime("%Y-%m-%d")
-            if(os.path.isfile(self.path+filename+".csv")):
-                print(filename, " existed!")
-            else:
-                try:
-                    self.requestInfo(currentDate)
-                except Exception as e:
-                    print("Error: ",e)  
-                    
-            currentDate = currentDate + timedelta(days=1)
\ No newline at end of file
+        self.backfill(self.listWindows())
+        self.closeSession()
@@ -43,8 +43,8 @@ Weather Condition Classification:
 
 
 '''
-severe_weather = ['Haze', 'Thunder', 'Storm', 'Heavy', 'Drizzlei'];
-mild_weather = ['Cloudy', 'Rain', 'Fog', 'Smoke', 'Mist'];
+severe_weather = ws.severe_weather
+mild_weather = ws.mild_weather
 
 '''
 index = 1